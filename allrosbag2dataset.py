@@ -1,17 +1,14 @@
 #!/usr/bin/python3
 
 import os
-import argparse
 import json
-import subprocess
+import argparse
 from glob import iglob
-from multiprocessing import Pool
-import shutil
 
+from manifest import Manifest, output_dir_for
+from scheduler import schedule
+from profiler import aggregate, print_summary
 
-def each_convert2torch(config_name):
-    command = "python3 ./rosbag2dataset.py --config /share/private/27th/hirotaka_saito/config/" + config_name
-    proc = subprocess.run(command,shell=True,stdout=subprocess.PIPE,text=True)
 
 def main():
 
@@ -20,8 +17,11 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-b", "--rosbag-dir", type=str, default="/share/private/27th/hirotaka_saito/bagfile/sq2/d_kan1/test/")
     parser.add_argument("-o", "--output-dir", type=str, default="/share/private/27th/hirotaka_saito/dataset/sq2/d_kan1/test_midas_point/")
-    parser.add_argument("-c", "--config-dir", type=str, default="/share/private/27th/hirotaka_saito/config/")
     parser.add_argument('--num-core', type=int, default=1)
+    parser.add_argument('--num-gpu', type=int, default=1, help="concurrent MiDaS jobs")
+    parser.add_argument('--profile', action='store_true', help="dump a cProfile of each bag to <out_dir>/profile.prof")
+    parser.add_argument('--claim', action='store_true', help="claim bags through lease files so several nodes can share the directories")
+    parser.add_argument('--lease-ttl', type=float, default=600, help="seconds after which a lease of a crashed node is taken over")
     args = parser.parse_args()
 
     config = {}
@@ -42,54 +42,47 @@ def main():
     config["collision_lower_bound"] = 0.3
     config["width"] = 224
     config["height"] = 224
+    config["num_workers"] = 4
     # config["midas_type"] = "MiDaS_small"
     config["midas_type"] = "DPT_Large"
     config["use_midas"] = False
     config["use_midas_point"] = True
+    config["midas_batch_size"] = 8
     config["divide_count"] = 1
+    config["cprofile"] = args.profile
+    config["claim_leases"] = args.claim
+    config["lease_ttl"] = args.lease_ttl
 
-    count = 1
-    rosbag_names = []
+    jobs = []
     for bag_path in iglob(os.path.join(args.rosbag_dir, "*")):
         _,expand = os.path.splitext(bag_path)
         if expand == ".bag":
-            rosbag_names.append(os.path.basename(bag_path))
-
-        if len(rosbag_names) == 0:
-            continue
-
-    for rosbag_name in rosbag_names:
-        config["bagfile_name"] = [f"{rosbag_name}"]
-        print(rosbag_name)
-
-        os.makedirs(args.config_dir, exist_ok=True)
-        with open(os.path.join(args.config_dir, f"config{count}.json"), "w") as f:
-            json.dump(config, f, indent=4)
-
-        count += 1
+            if Manifest(output_dir_for(config, bag_path)).is_complete(bag_path, config):
+                print("already converted: " + os.path.basename(bag_path))
+                continue
+            bag_config = dict(config)
+            bag_config["bagfile_name"] = [os.path.basename(bag_path)]
+            print(os.path.basename(bag_path))
+            jobs.append((bag_path, bag_config))
 
     print("\n" + "==== Created Config ====" + "\n")
-    os.makedirs(args.config_dir, exist_ok=True)
-
-    if args.num_core == 1:
-        for config_path in iglob(os.path.join(args.config_dir,"*")):
-            config_name = os.path.basename(config_path)
-            print(config_name)
-            command = "python3 ./rosbag2dataset.py --config /share/private/27th/hirotaka_saito/config/" + config_name
 
-            proc = subprocess.run(command,shell=True,stdout=subprocess.PIPE,text=True)
-            print(proc.check_returncode())
-            print(proc.stdout)
-    else:
-        config_names = []
-        for config_path in iglob(os.path.join(args.config_dir,"*")):
-            config_name = os.path.basename(config_path)
-            config_names.append(config_name)
+    results = schedule(jobs, num_cpu=args.num_core, num_gpu=args.num_gpu)
 
-        with Pool(args.num_core) as p:
-            p.map(each_convert2torch, config_names)
-
-    shutil.rmtree(args.config_dir)
+    # every converted bag left a profile.json next to its outputs
+    summaries = []
+    for bagfile, elapsed, result, error in results:
+        if result is None:
+            continue
+        with open(os.path.join(output_dir_for(config, bagfile), "profile.json"), "r") as f:
+            summaries.append(json.load(f))
+    if len(summaries) > 0:
+        total = aggregate(summaries)
+        total["per_bag"] = summaries
+        with open(os.path.join(args.output_dir, "profile_summary.json"), "w") as f:
+            json.dump(total, f, indent=4)
+        print("\n" + "==== Profile ====" + "\n")
+        print_summary(total)
 
 if __name__ == "__main__":
     main()
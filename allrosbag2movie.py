@@ -13,11 +13,14 @@ parser.add_argument('--image-topic', type=str, default='camera/color/image_raw/c
 parser.add_argument('--output-dir', type=str, default='/share/private/27th/hirotaka_saito/dataset/movie')
 parser.add_argument('--frame-rate', type=int, default=30)
 parser.add_argument('--num-core', type=int, default=5)
+parser.add_argument('--mjpeg', action='store_true')
 args = parser.parse_args()
 
 
 def each_convert2mp4(bag_path):
     command = "python3 ./rosbag2movie.py --bagfile " +  bag_path + " --image-topic " + args.image_topic + " --output-dir " + args.output_dir + " --frame-rate " + str(args.frame_rate)
+    if args.mjpeg:
+        command += " --mjpeg"
 
     proc = subprocess.run(command,shell=True,stdout=subprocess.PIPE,text=True)
     print(proc.check_returncode())
@@ -27,7 +30,7 @@ def main():
 
     count = 1
     bag_paths = []
-    for bag_path in iglob(os.path.join(args.rosbag_dir, "*")):
+    for bag_path in iglob(os.path.join(args.rosbag_dir, "*.bag")):
         bag_paths.append(bag_path)
 
     with Pool(args.num_core) as p:
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from resampler import resample, nearest_indices
+
+
+def legacy_convert_data(data, hz):
+    # the per-tick loop RosbagHandler.convert_data used before the resampler,
+    # kept here as the reference implementation
+    data_ = {}
+    start_time = 0
+    end_time = np.inf
+    idx = {}
+    for topic in data.keys():
+        start_time = max(start_time, data[topic][0][0])
+        end_time = min(end_time, data[topic][-1][0])
+        data_[topic] = []
+        idx[topic] = 1
+    t = start_time
+    ticks = []
+    while(t<end_time):
+        for topic in data.keys():
+            while(data[topic][idx[topic]][0]<t):
+                idx[topic]+=1
+            if (data[topic][idx[topic]][0]-t<t-data[topic][idx[topic]-1][0]):
+                data_[topic].append(data[topic][idx[topic]][1])
+            else:
+                data_[topic].append(data[topic][idx[topic]-1][1])
+        ticks.append(t)
+        t+=1./hz
+    return data_, np.array(ticks)
+
+def make_timeline(duration, rates, jitter, seed):
+    rng = np.random.default_rng(seed)
+    data = {}
+    for topic, rate in rates.items():
+        stamps = np.arange(0.0, duration, 1.0/rate)
+        stamps = np.sort(stamps + rng.uniform(-jitter, jitter, len(stamps))/rate)
+        data[topic] = [[t, i] for i, t in enumerate(stamps)]
+    return data
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=1800.0)
+    parser.add_argument('--hz', type=float, default=10)
+    parser.add_argument('--jitter', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rates = {"camera": 30, "odom": 50, "imu": 200, "scan": 40}
+    data = make_timeline(args.duration, rates, args.jitter, args.seed)
+    times = {topic: np.array([t for t, _ in data[topic]]) for topic in data.keys()}
+
+    t0 = time.perf_counter()
+    legacy, ticks = legacy_convert_data(data, args.hz)
+    legacy_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    grid, indices = resample(times, args.hz)
+    resample_time = time.perf_counter() - t0
+
+    # on the legacy (accumulated) tick grid the selections must be identical
+    for topic in data.keys():
+        idx, _ = nearest_indices(times[topic], ticks)
+        if list(idx) != legacy[topic]:
+            raise AssertionError("index selection differs for " + topic)
+    drift = 0
+    for topic in data.keys():
+        n = min(len(grid), len(legacy[topic]))
+        drift += int(np.count_nonzero(indices[topic][:n] != np.array(legacy[topic][:n])))
+
+    print("ticks:             " + str(len(ticks)))
+    print("legacy loop:       %.4f s" % legacy_time)
+    print("searchsorted:      %.4f s" % resample_time)
+    print("speedup:           %.1fx" % (legacy_time / resample_time))
+    print("drift differences: " + str(drift))
+
+if __name__ == '__main__':
+    main()
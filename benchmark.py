@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import os
+import time
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+import torch
+
+from rosbaghandler import RosbagHandler
+from resampler import resample, select
+from writer import PtWriter
+from synthbag import write_bag, add_arguments
+from bench_resample import legacy_convert_data
+from utils import *
+
+# topic of each input the stages need, as written by synthbag; a real bag
+# can name them differently (--odom-topic t_frog/odom) or lack some
+TOPIC_ARGUMENTS = [
+    ("camera", "camera/color/image_raw/compressed"),
+    ("raw_camera", "camera/color/image_raw"),
+    ("scan", "front_laser/scan"),
+    ("odom", "odom"),
+    ("imu", "imu/data"),
+    ("cmd_vel", "cmd_vel"),
+    ("pose", "amcl_pose"),
+]
+
+
+class StandInDepth(torch.nn.Module):
+    # tiny MiDaS stand-in with the same interface: (B,3,H,W) -> (B,H,W)
+    def __init__(self):
+        super().__init__()
+        self.net = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 3, padding=1),
+            torch.nn.ReLU(),
+            torch.nn.Conv2d(8, 1, 3, padding=1),
+        )
+
+    def forward(self, x):
+        return self.net(x)[:, 0]
+
+def stand_in_transform(img):
+    return torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).float().unsqueeze(0) / 255
+
+def timed(report, name, func, items=None, nbytes=None):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    stage = {"seconds": elapsed}
+    if items is None and hasattr(result, "__len__"):
+        items = len(result)
+    if items is not None:
+        stage["items"] = items
+        stage["items_per_s"] = items / elapsed if elapsed > 0 else None
+    if nbytes is not None:
+        stage["bytes"] = nbytes
+        stage["mb_per_s"] = nbytes / 1e6 / elapsed if elapsed > 0 else None
+    report["stages"][name] = stage
+    print("%-28s %8.3f s  %s" % (name, elapsed, "" if items is None else "%.1f items/s" % stage["items_per_s"]))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('--bagfile', type=str, default=None, help="benchmark an existing bag instead of a synthetic one")
+    parser.add_argument('--hz', type=float, default=10)
+    parser.add_argument('--traj-steps', type=int, default=100)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--midas-frames', type=int, default=64)
+    parser.add_argument('--midas-batch-size', type=int, default=8)
+    parser.add_argument('--output', type=str, default="benchmark.json")
+    for role, topic in TOPIC_ARGUMENTS:
+        parser.add_argument('--%s-topic' % role.replace("_", "-"), type=str, default=topic)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    work_dir = tempfile.mkdtemp(prefix="rosbag2dataset_bench_")
+    report = {"args": vars(args), "stages": {}}
+    try:
+        bagfile = args.bagfile
+        if bagfile is None:
+            bagfile = os.path.join(work_dir, "synthetic.bag")
+            count = timed(report, "generate_bag", lambda: write_bag(bagfile, args))
+            report["stages"]["generate_bag"]["items"] = count
+        report["bag_bytes"] = os.path.getsize(bagfile)
+
+        handler = RosbagHandler(bagfile)
+        topics = {}
+        for role, _ in TOPIC_ARGUMENTS:
+            topic = getattr(args, role + "_topic")
+            if "/" + topic in handler.info.topics:
+                topics[role] = topic
+            else:
+                print("no %s topic %s in the bag, skipping its stages" % (role, topic))
+        bag_topics = list(topics.values())
+        columns = {}
+        for topic in bag_topics:
+            topic_type = handler.get_topic_type(topic)
+            if topic_type in COLUMN_EXTRACTORS:
+                columns[topic] = make_column_buffer(topic_type)
+        timeline = timed(report, "bag_read", lambda: handler.read_timeline(bag_topics, columns=dict(columns)),
+                         items=sum(handler.info.topics["/"+topic].message_count for topic in bag_topics),
+                         nbytes=report["bag_bytes"])
+        times = {topic: timeline[topic][0] for topic in bag_topics}
+
+        legacy = {topic: [[t, i] for i, t in enumerate(times[topic])] for topic in bag_topics}
+        timed(report, "resample_legacy_loop", lambda: legacy_convert_data(legacy, args.hz)[1])
+        grid, indices = timed(report, "resample_searchsorted", lambda: resample(times, args.hz), items=None)
+        report["stages"]["resample_searchsorted"]["items"] = len(grid)
+
+        def sample(role):
+            return select(timeline[topics[role]][1], indices[topics[role]])
+
+        fields = {}
+        if "camera" in topics:
+            images = sample("camera")
+            fields["obs"] = timed(report, "convert_CompressedImage",
+                                  lambda: convert_CompressedImage(images, args.image_size, args.image_size, args.num_workers),
+                                  nbytes=sum(len(msg.data) for msg in images))
+        if "raw_camera" in topics:
+            raw_images = sample("raw_camera")
+            timed(report, "convert_Image", lambda: convert_Image(raw_images, args.image_size, args.image_size, args.num_workers),
+                  nbytes=sum(len(msg.data) for msg in raw_images))
+        if "scan" in topics:
+            fields["lidar"] = timed(report, "convert_LaserScan", lambda: convert_LaserScan(sample("scan")))
+        if "odom" in topics:
+            fields["acs"], pos = timed(report, "convert_Odometry",
+                                       lambda: convert_Odometry(sample("odom"), 0.1, [0.0, -1.5], [1.5, 1.5]),
+                                       items=len(grid))
+            timed(report, "pose_outputs", lambda: relative_trajectories(pos, len(pos) // args.traj_steps, args.traj_steps))
+        if "imu" in topics:
+            fields["imu"] = timed(report, "convert_Imu", lambda: convert_Imu(sample("imu")))
+        if "cmd_vel" in topics:
+            timed(report, "convert_Twist",
+                  lambda: convert_Twist(sample("cmd_vel"), 0.1, [0.0, -1.5], [1.5, 1.5], hz=args.hz, use_pose=True),
+                  items=len(grid))
+        if "pose" in topics:
+            timed(report, "convert_PoseWithCovarianceStamped", lambda: convert_PoseWithCovarianceStamped(sample("pose")))
+
+        if "obs" in fields:
+            model = StandInDepth().eval()
+            frames = fields["obs"][:args.midas_frames]
+            timed(report, "midas_depth_stand_in",
+                  lambda: convert_CompressedImage_depth(frames, model, torch.device("cpu"), stand_in_transform,
+                                                        args.image_size, args.image_size, args.midas_batch_size))
+            timed(report, "midas_point_stand_in",
+                  lambda: convert_CompressedImage_depth2point(frames, model, torch.device("cpu"), stand_in_transform,
+                                                              args.image_size, args.image_size, args.midas_batch_size))
+
+        out_dir = os.path.join(work_dir, "dataset")
+        for data_name in fields.keys():
+            os.makedirs(os.path.join(out_dir, data_name), exist_ok=True)
+        num_traj = len(grid) // args.traj_steps
+
+        def write_all():
+            writer = PtWriter(out_dir)
+            for idx in range(num_traj):
+                t0 = idx*args.traj_steps
+                for data_name, values in fields.items():
+                    writer.write(idx, data_name, torch.tensor(np.asarray(values[t0:t0+args.traj_steps]), dtype=torch.float32))
+            writer.close()
+            return num_traj
+        timed(report, "pt_writer", write_all, items=num_traj)
+        written = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(out_dir) for f in files)
+        report["stages"]["pt_writer"]["bytes"] = written
+        report["stages"]["pt_writer"]["mb_per_s"] = written / 1e6 / report["stages"]["pt_writer"]["seconds"]
+    finally:
+        shutil.rmtree(work_dir)
+
+    # ru_maxrss is in kilobytes on Linux
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print("report: " + args.output)
+
+if __name__ == '__main__':
+    main()
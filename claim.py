@@ -0,0 +1,68 @@
+import os
+import glob
+import shutil
+
+from lease import Lease
+from manifest import Manifest, output_dir_for
+from rosbag2dataset import convert_bagfile
+
+
+def lease_dir_for(config):
+    return config.get("lease_dir") or os.path.join(config["output_dir"], ".leases")
+
+def adopt_partial(out_dir, work_dir, bagfile, config):
+    # reuse the output of a node that crashed on this bag so its manifest can
+    # resume it; only the lease holder gets here, so nobody else writes them
+    partials = [path for path in glob.glob(glob.escape(out_dir) + ".partial.*") if path != work_dir]
+    best = None
+    for path in partials:
+        manifest = Manifest(path)
+        if manifest.matches(bagfile, config) and (best is None or manifest.entry["num_traj"] > best[1]):
+            best = (path, manifest.entry["num_traj"])
+    for path in partials:
+        if best is not None and path == best[0]:
+            print("resuming partial output " + path)
+            os.rename(path, work_dir)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+def publish(work_dir, out_dir, owner):
+    # the finished output replaces out_dir in one rename; an older incomplete
+    # out_dir is moved aside first since a directory cannot be renamed over
+    if os.path.exists(out_dir):
+        old = out_dir + ".old." + owner
+        os.rename(out_dir, old)
+        shutil.rmtree(old)
+    os.rename(work_dir, out_dir)
+
+def convert_claimed(bagfile, config, midas_ctx):
+    # coordinator-free mode for several nodes sharing bag and output
+    # directories: the bag is converted only by the node holding its lease,
+    # into <out_dir>.partial.<host>-<pid>, renamed to out_dir when complete
+    out_dir = output_dir_for(config, bagfile)
+    if Manifest(out_dir).is_complete(bagfile, config):
+        print("already converted: " + bagfile)
+        return None
+    lease = Lease(lease_dir_for(config), os.path.basename(out_dir), config.get("lease_ttl", 600))
+    if not lease.acquire({"bagfile": os.path.abspath(bagfile)}):
+        print("claimed by another node: " + bagfile)
+        return None
+    lease.start_renewing()
+    try:
+        # another node may have finished it between the check and the claim
+        if Manifest(out_dir).is_complete(bagfile, config):
+            print("already converted: " + bagfile)
+            return None
+        work_dir = out_dir + ".partial." + lease.owner
+        adopt_partial(out_dir, work_dir, bagfile, config)
+        result = convert_bagfile(bagfile, config, midas_ctx, work_dir)
+        if result is None:
+            # the adopted output was already complete, only the rename was missing
+            entry = Manifest(work_dir).entry
+            result = entry["num_steps"], entry["num_traj"]
+        if lease.lost:
+            raise RuntimeError("lease on %s was taken over, not publishing %s" % (bagfile, work_dir))
+        publish(work_dir, out_dir, lease.owner)
+        return result
+    finally:
+        lease.release()
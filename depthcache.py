@@ -0,0 +1,80 @@
+import os
+import hashlib
+import uuid
+import collections
+
+import numpy as np
+
+
+class DepthCache:
+    # on-disk cache of normalized MiDaS depth maps, one uint8 .npy per frame
+    # keyed by the compressed image bytes, the model type and the output size.
+    # file mtimes double as the LRU order so the cache survives across runs
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        self.entries = collections.OrderedDict()
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+        self.total_bytes = sum(self.entries.values())
+
+    def key(self, data, model_type, height, width):
+        h = hashlib.sha1(bytes(data))
+        h.update(("%s:%sx%s" % (model_type, height, width)).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            depth = np.load(self.path(key), mmap_mode="r")
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            # evicted by another process sharing the cache
+            self.total_bytes -= self.entries.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return depth
+
+    def put(self, key, depth):
+        path = self.path(key)
+        tmp_path = path + ".%s.tmp" % uuid.uuid4().hex
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(depth, dtype=np.uint8))
+        os.replace(tmp_path, path)
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)
+        self.entries[key] = os.path.getsize(path)
+        self.total_bytes += self.entries[key]
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total > 0 else 0.0
+        print("depth cache: %d hits, %d misses (%.1f%%), %d entries, %.1f MB"
+              % (self.hits, self.misses, rate, len(self.entries), self.total_bytes / 1e6))
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import socket
+import threading
+
+
+class Lease:
+    # a claim on one unit of work held as lease_dir/<name>.lease. creating it
+    # with O_EXCL is atomic (also on NFSv3+), so only one node gets it. the
+    # holder keeps touching it; a lease left untouched for ttl seconds
+    # belongs to a crashed node and is taken over
+    def __init__(self, lease_dir, name, ttl=600):
+        self.path = os.path.join(lease_dir, name + ".lease")
+        self.ttl = ttl
+        self.owner = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.held = False
+        self.lost = False
+        self.stop = threading.Event()
+        self.thread = None
+
+    def acquire(self, info=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        for attempt in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt > 0 or not self.take_over_stale():
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                entry = dict(info or {})
+                entry["owner"] = self.owner
+                entry["acquired"] = time.time()
+                json.dump(entry, f)
+            self.held = True
+            return True
+        return False
+
+    def take_over_stale(self):
+        try:
+            if time.time() - os.stat(self.path).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            # released in the meantime, try to create it again
+            return True
+        # rename is atomic, so of several nodes that saw the same stale
+        # lease only one moves it away
+        stale = self.path + ".stale." + self.owner
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return False
+        try:
+            if time.time() - os.stat(stale).st_mtime < self.ttl:
+                # it was renewed or re-created after our check; put it back
+                try:
+                    os.link(stale, self.path)
+                except OSError:
+                    pass
+                return False
+            with open(stale, "r") as f:
+                print("taking over stale lease of %s: %s" % (json.load(f).get("owner"), self.path))
+        except (OSError, ValueError):
+            pass
+        finally:
+            os.remove(stale)
+        return True
+
+    def owned(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f).get("owner") == self.owner
+        except (OSError, ValueError):
+            return False
+
+    def renew(self):
+        if not self.owned():
+            return False
+        os.utime(self.path)
+        return True
+
+    def start_renewing(self):
+        def run():
+            while not self.stop.wait(self.ttl / 4):
+                if not self.renew():
+                    print("lost lease: " + self.path)
+                    self.lost = True
+                    return
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def release(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.held and self.owned():
+            os.remove(self.path)
+        self.held = False
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import collections
+
+
+# config keys that change how a bag is converted but not what is written
+RUNTIME_KEYS = ["bagfile_name", "bagfile_dir", "output_dir", "num_workers", "worker_backend",
+                "midas_batch_size", "depth_cache_dir", "depth_cache_max_gb", "streaming", "cprofile",
+                "writer_threads", "writer_queue_mb", "segment_workers",
+                "claim_leases", "lease_dir", "lease_ttl", "bag_cache_dir"]
+
+def output_dir_for(config, bagfile):
+    file_name = os.path.splitext(os.path.basename(bagfile))[0]+"_traj"+str(config["traj_steps"])
+    return os.path.join(config["output_dir"], file_name)
+
+def bag_cache_dir_for(config):
+    # bag info and index sidecars, kept out of the bag directories
+    return config.get("bag_cache_dir") or os.path.join(config["output_dir"], ".bag_cache")
+
+def config_hash(config):
+    relevant = {key: value for key, value in config.items() if key not in RUNTIME_KEYS}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+def fingerprint(bagfile, sample_bytes=1 << 20):
+    # size plus the first and last MB; the bag header and index live there,
+    # so rewritten or truncated bags change it without hashing the whole file
+    size = os.path.getsize(bagfile)
+    h = hashlib.sha1(str(size).encode())
+    with open(bagfile, "rb") as f:
+        h.update(f.read(sample_bytes))
+        if size > sample_bytes:
+            f.seek(max(size - sample_bytes, sample_bytes))
+            h.update(f.read(sample_bytes))
+    return h.hexdigest()
+
+
+class Manifest:
+    # out_dir/manifest.json records which bag and config produced the outputs
+    # in out_dir and how many trajectories are known to be fully written
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, "manifest.json")
+        self.entry = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.entry = json.load(f)
+            except ValueError:
+                self.entry = None
+
+    def matches(self, bagfile, config):
+        if self.entry is None or self.entry["config_hash"] != config_hash(config):
+            return False
+        stat = os.stat(bagfile)
+        if self.entry["size"] != stat.st_size:
+            return False
+        if self.entry["mtime"] == stat.st_mtime:
+            return True
+        return self.entry["fingerprint"] == fingerprint(bagfile)
+
+    def is_complete(self, bagfile, config):
+        return self.matches(bagfile, config) and self.entry["status"] == "complete"
+
+    def resume_from(self, bagfile, config):
+        # number of trajectories that can be kept from an interrupted run
+        # shard and JPEG indexes are only written at the end, so only
+        # plain .pt outputs can be resumed
+        if self.matches(bagfile, config) and config.get("output_format", "pt") == "pt" and not config.get("jpeg_fields"):
+            return self.entry["num_traj"]
+        return 0
+
+    def start(self, bagfile, config, num_traj=0):
+        stat = os.stat(bagfile)
+        self.entry = {
+            "bagfile": os.path.abspath(bagfile),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "fingerprint": fingerprint(bagfile),
+            "config_hash": config_hash(config),
+            "status": "partial",
+            "num_traj": num_traj,
+        }
+        self.save()
+
+    def progress(self, num_traj):
+        self.entry["num_traj"] = num_traj
+        self.save()
+
+    def complete(self, num_steps, num_traj):
+        self.entry["status"] = "complete"
+        self.entry["num_steps"] = num_steps
+        self.entry["num_traj"] = num_traj
+        self.save()
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entry, f, indent=4)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class ResumingWriter:
+    # skips trajectories finished by an earlier run and checkpoints progress
+    # into the manifest every save_every trajectories. with an AsyncWriter a
+    # trajectory only counts once every one of its writes has succeeded
+    def __init__(self, writer, manifest, resume_from=0, save_every=50):
+        self.writer = writer
+        self.manifest = manifest
+        self.resume_from = resume_from
+        self.save_every = save_every
+        self.current = None
+        self.done = resume_from
+        self.futures = {}
+        self.sealed = collections.deque()
+
+    def write(self, file_count, data_name, data):
+        if file_count < self.resume_from:
+            return
+        if file_count != self.current:
+            # every field of the previous trajectory has been handed over
+            if self.current is not None:
+                self.finished(self.current)
+            self.current = file_count
+            self.futures[file_count] = []
+        future = self.writer.write(file_count, data_name, data)
+        if future is not None:
+            self.futures[file_count].append(future)
+
+    def finished(self, file_count):
+        self.sealed.append(file_count)
+        self.collect()
+
+    def collect(self):
+        # advance over the leading trajectories whose writes have all succeeded
+        while len(self.sealed) > 0:
+            futures = self.futures[self.sealed[0]]
+            if not all(future.done() and future.exception() is None for future in futures):
+                return
+            file_count = self.sealed.popleft()
+            del self.futures[file_count]
+            self.done = max(self.done, file_count + 1)
+            if self.done % self.save_every == 0:
+                self.manifest.progress(self.done)
+
+    def close(self):
+        if self.current is not None:
+            self.finished(self.current)
+            self.current = None
+        # raises if any write failed, so progress is never recorded past it
+        self.writer.close()
+        self.collect()
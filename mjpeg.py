@@ -0,0 +1,125 @@
+import struct
+
+
+class MjpegAviWriter:
+    # minimal AVI (RIFF) muxer for a single MJPEG video stream; JPEG frames
+    # are stored as-is so nothing is decoded or re-encoded.
+    # a RIFF chunk has a 32-bit size, so the file is split OpenDML style into
+    # an "AVI " RIFF followed by "AVIX" RIFFs of about riff_limit bytes each.
+    # every movi list ends with an ix00 index of its frames, listed in the
+    # indx super index of the stream header; idx1 covers the first RIFF for
+    # readers that only know AVI 1.0
+    def __init__(self, path, fps, width, height, riff_limit=1 << 30, max_riffs=1024):
+        self.f = open(path, "wb")
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.riff_limit = riff_limit
+        self.max_riffs = max_riffs
+        self.index = []
+        self.first_index = None
+        self.super_index = []
+        self.max_frame = 0
+        self.num_frames = 0
+        self.write_header()
+        self.start_movi()
+
+    def write_header(self):
+        f = self.f
+        indx_size = 24 + 16 * self.max_riffs
+        strl_size = 4 + (8 + 56) + (8 + 40) + (8 + indx_size)
+        odml_size = 4 + 8 + 248
+        self.riff_pos = 0
+        f.write(b"RIFF" + struct.pack("<I", 0) + b"AVI ")
+        f.write(b"LIST" + struct.pack("<I", 4 + (8 + 56) + (8 + strl_size) + (8 + odml_size)) + b"hdrl")
+        self.avih_pos = f.tell()
+        f.write(b"avih" + struct.pack("<I", 56))
+        f.write(struct.pack("<14I",
+                            int(round(1e6 / self.fps)), 0, 0, 0x10, 0, 0, 1, 0,
+                            self.width, self.height, 0, 0, 0, 0))
+        f.write(b"LIST" + struct.pack("<I", strl_size) + b"strl")
+        self.strh_pos = f.tell()
+        f.write(b"strh" + struct.pack("<I", 56))
+        f.write(b"vids" + b"MJPG")
+        f.write(struct.pack("<IHHIIIIIIIIhhhh",
+                            0, 0, 0, 0, 1000, int(round(self.fps * 1000)), 0, 0, 0, 0xFFFFFFFF, 0,
+                            0, 0, self.width, self.height))
+        f.write(b"strf" + struct.pack("<I", 40))
+        f.write(struct.pack("<IiiHH4sIiiII",
+                            40, self.width, self.height, 1, 24, b"MJPG",
+                            self.width * self.height * 3, 0, 0, 0, 0))
+        # super index, filled in by release()
+        self.indx_pos = f.tell()
+        f.write(b"indx" + struct.pack("<I", indx_size) + bytes(indx_size))
+        f.write(b"LIST" + struct.pack("<I", odml_size) + b"odml")
+        self.dmlh_pos = f.tell()
+        f.write(b"dmlh" + struct.pack("<I", 248) + bytes(248))
+
+    def start_movi(self):
+        self.movi_pos = self.f.tell()
+        self.f.write(b"LIST" + struct.pack("<I", 0) + b"movi")
+
+    def start_riff(self):
+        self.riff_pos = self.f.tell()
+        self.f.write(b"RIFF" + struct.pack("<I", 0) + b"AVIX")
+        self.start_movi()
+
+    def write(self, jpeg):
+        jpeg = bytes(jpeg)
+        size = 8 + len(jpeg) + len(jpeg) % 2
+        if len(self.index) > 0 and self.f.tell() + size - self.riff_pos > self.riff_limit:
+            self.end_riff()
+            self.start_riff()
+        # offset of the frame data from the "movi" list, size of the data
+        self.index.append((self.f.tell() + 8 - self.movi_pos, len(jpeg)))
+        self.f.write(b"00dc" + struct.pack("<I", len(jpeg)) + jpeg)
+        if len(jpeg) % 2 == 1:
+            self.f.write(b"\0")
+        self.max_frame = max(self.max_frame, len(jpeg))
+        self.num_frames += 1
+
+    def end_riff(self):
+        f = self.f
+        if len(self.super_index) == self.max_riffs:
+            raise RuntimeError("MJPEG stream longer than %d RIFF segments" % self.max_riffs)
+        # standard index of the frames in this movi list
+        ix_pos = f.tell()
+        ix_size = 24 + 8 * len(self.index)
+        f.write(b"ix00" + struct.pack("<IHBBI4sQI", ix_size, 2, 0, 1, len(self.index), b"00dc", self.movi_pos, 0))
+        for offset, size in self.index:
+            f.write(struct.pack("<II", offset, size))
+        self.super_index.append((ix_pos, 8 + ix_size, len(self.index)))
+        movi_end = f.tell()
+        if self.first_index is None:
+            # idx1 offsets are relative to the "movi" fourcc
+            self.first_index = self.index
+            f.write(b"idx1" + struct.pack("<I", 16 * len(self.index)))
+            for offset, size in self.index:
+                f.write(b"00dc" + struct.pack("<III", 0x10, offset - 16, size))
+        riff_end = f.tell()
+        f.seek(self.riff_pos + 4)
+        f.write(struct.pack("<I", riff_end - self.riff_pos - 8))
+        f.seek(self.movi_pos + 4)
+        f.write(struct.pack("<I", movi_end - self.movi_pos - 8))
+        f.seek(riff_end)
+        self.index = []
+
+    def release(self):
+        f = self.f
+        self.end_riff()
+        f.seek(self.indx_pos + 8)
+        f.write(struct.pack("<HBBI4s3I", 4, 0, 0, len(self.super_index), b"00dc", 0, 0, 0))
+        for offset, size, duration in self.super_index:
+            f.write(struct.pack("<QII", offset, size, duration))
+        # total frames and suggested buffer size in avih; AVI 1.0 readers
+        # only see the first RIFF
+        f.seek(self.avih_pos + 8 + 16)
+        f.write(struct.pack("<I", len(self.first_index)))
+        f.seek(self.avih_pos + 8 + 28)
+        f.write(struct.pack("<I", self.max_frame))
+        # stream length and suggested buffer size in strh
+        f.seek(self.strh_pos + 8 + 32)
+        f.write(struct.pack("<II", self.num_frames, self.max_frame))
+        f.seek(self.dmlh_pos + 8)
+        f.write(struct.pack("<I", self.num_frames))
+        f.close()
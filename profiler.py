@@ -0,0 +1,159 @@
+import os
+import time
+import json
+import resource
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+def io_counters():
+    # bytes this process has read and written so far, including page cache
+    # hits (Linux only, zeros elsewhere)
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss_mb():
+    # VmHWM can be reset per bag, ru_maxrss (kilobytes on Linux) only grows
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class Profiler:
+    # accumulates wall time, item counts and bytes per named stage; stages
+    # may nest (bag_read runs inside convert_bag) and may be recorded from
+    # worker threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.start = time.perf_counter()
+        reset_peak_rss()
+
+    def add(self, name, seconds=0.0, items=0, bytes_read=0, bytes_written=0, calls=1):
+        peak = peak_rss_mb()
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = new_stage()
+            stage = self.stages[name]
+            stage["seconds"] += seconds
+            stage["calls"] += calls
+            stage["items"] += items
+            stage["bytes_read"] += bytes_read
+            stage["bytes_written"] += bytes_written
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak)
+
+    @contextmanager
+    def stage(self, name, items=0, io=False):
+        # the yielded dict can be updated with items/bytes_read/bytes_written;
+        # with io the process-wide read/write counters are used for the bytes
+        record = {"items": items, "bytes_read": 0, "bytes_written": 0}
+        if io:
+            rchar, wchar = io_counters()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            if io:
+                rchar_end, wchar_end = io_counters()
+                record["bytes_read"] += rchar_end - rchar
+                record["bytes_written"] += wchar_end - wchar
+            self.add(name, seconds, record["items"], record["bytes_read"], record["bytes_written"])
+
+    def merge(self, summary):
+        # stages recorded by another process, e.g. a segment worker
+        with self.lock:
+            for name, other in summary["stages"].items():
+                if name not in self.stages:
+                    self.stages[name] = new_stage()
+                stage = self.stages[name]
+                for key in ["seconds", "calls", "items", "bytes_read", "bytes_written"]:
+                    stage[key] += other[key]
+                stage["peak_rss_mb"] = max(stage["peak_rss_mb"], other["peak_rss_mb"])
+
+    def summary(self):
+        with self.lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            wall = time.perf_counter() - self.start
+        for stage in stages.values():
+            add_rates(stage)
+        return {"wall_seconds": wall, "peak_rss_mb": peak_rss_mb(), "stages": stages}
+
+    def save(self, path, **extra):
+        summary = self.summary()
+        summary.update(extra)
+        with open(path + ".tmp", "w") as f:
+            json.dump(summary, f, indent=4)
+        os.replace(path + ".tmp", path)
+        return summary
+
+
+def new_stage():
+    return {"seconds": 0.0, "calls": 0, "items": 0, "bytes_read": 0, "bytes_written": 0, "peak_rss_mb": 0.0}
+
+def add_rates(stage):
+    seconds = stage["seconds"]
+    stage["items_per_s"] = stage["items"] / seconds if seconds > 0 else 0.0
+    stage["mb_read_per_s"] = stage["bytes_read"] / 1e6 / seconds if seconds > 0 else 0.0
+    stage["mb_written_per_s"] = stage["bytes_written"] / 1e6 / seconds if seconds > 0 else 0.0
+
+def print_summary(summary):
+    print("%-28s %10s %8s %10s %12s %10s %10s %9s" % ("stage", "seconds", "calls", "items", "items/s", "MB read", "MB written", "peak MB"))
+    for name, stage in sorted(summary["stages"].items(), key=lambda s: -s[1]["seconds"]):
+        print("%-28s %10.2f %8d %10d %12.1f %10.1f %10.1f %9.0f" % (
+            name, stage["seconds"], stage["calls"], stage["items"], stage["items_per_s"],
+            stage["bytes_read"] / 1e6, stage["bytes_written"] / 1e6, stage["peak_rss_mb"]))
+    print("wall: %.1f s, peak rss: %.1f MB" % (summary["wall_seconds"], summary["peak_rss_mb"]))
+
+def aggregate(summaries):
+    # totals over several per-bag summaries; peak memory is the worst bag
+    total = {"wall_seconds": 0.0, "peak_rss_mb": 0.0, "stages": {}, "bags": len(summaries)}
+    for summary in summaries:
+        total["wall_seconds"] += summary["wall_seconds"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], summary["peak_rss_mb"])
+        for name, stage in summary["stages"].items():
+            if name not in total["stages"]:
+                total["stages"][name] = new_stage()
+            merged = total["stages"][name]
+            for key in ["seconds", "calls", "items", "bytes_read", "bytes_written"]:
+                merged[key] += stage[key]
+            merged["peak_rss_mb"] = max(merged["peak_rss_mb"], stage["peak_rss_mb"])
+    for stage in total["stages"].values():
+        add_rates(stage)
+    return total
+
+def profiled(name):
+    # times every call of a convert_* style function; items is len(data)
+    def decorator(func):
+        @wraps(func)
+        def wrapper(data, *args, **kwargs):
+            items = len(data) if hasattr(data, "__len__") else 0
+            with profiler.stage(name, items):
+                return func(data, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# one per process; convert_bagfile resets it at the start of every bag
+profiler = Profiler()
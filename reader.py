@@ -0,0 +1,108 @@
+import os
+import json
+import collections
+
+import numpy as np
+import torch
+import cv2
+from torch.utils.data import Dataset
+
+from writer import load_jpeg_index, load_shard_index, shard_view
+
+
+class TrajectoryDataset(Dataset):
+    # one item per trajectory of a converted bag, {data_name: tensor}.
+    # jpeg_fields are decoded on access, i.e. inside DataLoader workers, and
+    # each worker keeps an LRU of up to cache_frames decoded frames; pt fields
+    # are loaded as written and shard fields are zero-copy views of shards
+    # memory-mapped once per process
+    def __init__(self, out_dir, fields=None, cache_frames=1024):
+        with open(os.path.join(out_dir, "info.txt"), "r") as f:
+            self.config = json.load(f)
+        self.out_dir = out_dir
+        if fields is None:
+            fields = []
+            for data_name in self.config["dataset"]:
+                if "obs3" in self.config["dataset"] and data_name == "obs":
+                    continue
+                if "obs3d" in self.config["dataset"] and data_name == "obsd":
+                    continue
+                fields.append(data_name)
+        self.fields = fields
+        self.num_traj = self.config["num_traj"]
+        self.jpeg = {}
+        self.shards = {}
+        for data_name in self.fields:
+            if data_name in self.config.get("jpeg_fields", []):
+                self.jpeg[data_name] = load_jpeg_index(os.path.join(out_dir, data_name))
+            elif self.config.get("output_format", "pt") == "shard":
+                self.shards[data_name] = load_shard_index(os.path.join(out_dir, data_name))
+        self.cache_frames = cache_frames
+        self.cache = collections.OrderedDict()
+        self.fds = {}
+        self.memmaps = {}
+        self.pid = None
+
+    def __getstate__(self):
+        # sent to spawned DataLoader workers without open files or maps
+        state = dict(self.__dict__)
+        state["fds"] = {}
+        state["memmaps"] = {}
+        state["cache"] = collections.OrderedDict()
+        state["pid"] = None
+        return state
+
+    def __len__(self):
+        return self.num_traj
+
+    def __getitem__(self, file_count):
+        item = {}
+        for data_name in self.fields:
+            if data_name in self.jpeg:
+                dtype = getattr(torch, self.config.get("output_dtypes", {}).get(data_name, "float32"))
+                data = torch.from_numpy(self.decode(data_name, file_count))
+                item[data_name] = data if data.dtype == dtype else data.to(dtype)
+            elif data_name in self.shards:
+                trajectories, dtype = self.shards[data_name]
+                path, offset, shape = trajectories[file_count]
+                item[data_name] = torch.from_numpy(shard_view(self.memmap(path), offset, shape, dtype))
+            else:
+                item[data_name] = torch.load(os.path.join(self.out_dir, data_name, "%d.pt" % (file_count)))
+        return item
+
+    def check_process(self):
+        # file descriptors, memory maps and cached frames are per process; a
+        # DataLoader worker gets its own after fork or spawn
+        if self.pid != os.getpid():
+            self.fds = {}
+            self.memmaps = {}
+            self.cache.clear()
+            self.pid = os.getpid()
+
+    def memmap(self, path):
+        self.check_process()
+        if path not in self.memmaps:
+            self.memmaps[path] = np.memmap(path, dtype=np.uint8, mode="c")
+        return self.memmaps[path]
+
+    def read(self, path, offset, size):
+        self.check_process()
+        if path not in self.fds:
+            self.fds[path] = os.open(path, os.O_RDONLY)
+        return os.pread(self.fds[path], size, offset)
+
+    def decode(self, data_name, file_count):
+        path, offsets, sizes, shape = self.jpeg[data_name][file_count]
+        frames = np.empty(shape, dtype=np.uint8)
+        view = frames.reshape((-1,) + shape[-3:])
+        for i, (offset, size) in enumerate(zip(offsets, sizes)):
+            key = (path, int(offset))
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                buf = np.frombuffer(self.read(path, int(offset), int(size)), np.uint8)
+                self.cache[key] = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED).reshape(shape[-3:])
+                if len(self.cache) > self.cache_frames:
+                    self.cache.popitem(last=False)
+            view[i] = self.cache[key]
+        return frames
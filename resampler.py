@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def make_grid(start_time, end_time, hz):
+    # tick k is start_time + k/hz, computed directly so long bags do not drift
+    num = int(np.floor((end_time - start_time) * hz)) + 1
+    grid = start_time + np.arange(max(num, 0)) / hz
+    return grid[grid < end_time]
+
+def nearest_indices(times, grid, max_staleness=None):
+    # same choice as the old loop: the first message at or after t unless the
+    # previous one is strictly closer, ties go to the previous message
+    idx = np.searchsorted(times, grid, side="left")
+    idx = np.clip(idx, 1, len(times)-1)
+    take_next = times[idx] - grid < grid - times[idx-1]
+    idx = np.where(take_next, idx, idx-1)
+    if max_staleness is None:
+        valid = np.ones(len(grid), dtype=bool)
+    else:
+        valid = np.abs(times[idx] - grid) <= max_staleness
+    return idx, valid
+
+def select(values, indices):
+    # values is a message list or an array of extracted columns
+    if isinstance(values, np.ndarray):
+        return values[indices]
+    return [values[i] for i in indices]
+
+def interpolate(times, values, grid, angle_columns=()):
+    values = np.asarray(values, dtype=np.float64)
+    out = np.empty((len(grid),) + values.shape[1:], dtype=np.float64)
+    for col in range(values.shape[1]):
+        column = values[:, col]
+        if col in angle_columns:
+            column = np.unwrap(column)
+        out[:, col] = np.interp(grid, times, column)
+        if col in angle_columns:
+            out[:, col] = np.arctan2(np.sin(out[:, col]), np.cos(out[:, col]))
+    return out
+
+def resample(times, hz, start_time=None, max_staleness=None):
+    # times: {topic: sorted 1-D array of stamps}
+    # returns the tick grid and {topic: message index per tick}; with
+    # max_staleness, ticks where any topic is further away than that are dropped
+    first = {}
+    grid_start = 0
+    grid_end = np.inf
+    for topic in times.keys():
+        first[topic] = 0
+        if start_time is not None:
+            first[topic] = int(np.searchsorted(times[topic], start_time, side="left"))
+        grid_start = max(grid_start, times[topic][first[topic]])
+        grid_end = min(grid_end, times[topic][-1])
+    grid = make_grid(grid_start, grid_end, hz)
+    indices = {}
+    valid = np.ones(len(grid), dtype=bool)
+    for topic in times.keys():
+        idx, topic_valid = nearest_indices(times[topic][first[topic]:], grid, max_staleness)
+        indices[topic] = idx + first[topic]
+        valid &= topic_valid
+    if not valid.all():
+        grid = grid[valid]
+        for topic in indices.keys():
+            indices[topic] = indices[topic][valid]
+    return grid, indices
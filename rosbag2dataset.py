@@ -1,17 +1,558 @@
 #!/usr/bin/env python3
 import os
+import glob
 import argparse
 import json
+import resource
+import cProfile
+import pstats
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+import numpy as np
 import torch
 
 from rosbaghandler import RosbagHandler
+from resampler import interpolate, select
+from depthcache import DepthCache
+from writer import make_writer
+from manifest import Manifest, ResumingWriter, output_dir_for, bag_cache_dir_for
+from streaming import resample_stream, chunked, windows
+from profiler import profiler, print_summary
 from utils import *
 
-if __name__ == '__main__':
+CAMERA_FIELDS = {
+    "camera/color/image_raw/compressed": ("obs", "obsd"),
+    "front_right_camera/color/image_raw/compressed": ("obsright", "obsrightd"),
+    "front_left_camera/color/image_raw/compressed": ("obsleft", "obsleftd"),
+}
+
+# obs3/obs3d put the cameras side by side in this order
+CAMERA_RIG = [
+    "front_left_camera/color/image_raw/compressed",
+    "camera/color/image_raw/compressed",
+    "front_right_camera/color/image_raw/compressed",
+]
+
+def load_midas(config):
+    model_type = config["midas_type"]
+    midas = torch.hub.load("intel-isl/MiDaS", model_type)
+    midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    midas.to(device)
+    midas.eval()
+
+    if model_type == "DPT_Large" or model_type == "DPT_Hybrid":
+        transform = midas_transforms.dpt_transform
+    else:
+        transform = midas_transforms.small_transform
+
+    depth_cache = None
+    if config.get("depth_cache_dir"):
+        max_bytes = None
+        if config.get("depth_cache_max_gb"):
+            max_bytes = int(config["depth_cache_max_gb"] * 1e9)
+        depth_cache = DepthCache(config["depth_cache_dir"], max_bytes)
+    return midas, device, transform, depth_cache
+
+def convert_camera(msgs, topic, config, midas_ctx):
+    obs_name, obsd_name = CAMERA_FIELDS[topic]
+    fields = {}
+    fields[obs_name] = convert_CompressedImage(msgs, config["height"], config["width"],
+                                               config.get("num_workers", 1), config.get("worker_backend", "thread"),
+                                               config.get("reduced_decode", True))
+    if midas_ctx is None:
+        return fields
+    midas, device, transform, depth_cache = midas_ctx
+    keys = None
+    if depth_cache is not None:
+        keys = [depth_cache.key(msg.data, config["midas_type"], config["height"], config["width"]) for msg in msgs]
+    use_point = config["use_midas_point"] and obs_name == "obs"
+    if not config["use_midas"] and not use_point:
+        return fields
+    # one MiDaS pass serves both obsd and midas_point
+    depths = predict_depth_cached(fields[obs_name], midas, device, transform, config["height"], config["width"],
+                                  config.get("midas_batch_size", 1), depth_cache, keys)
+    if config["use_midas"]:
+        fields[obsd_name] = depths / np.float32(255)
+    if use_point:
+        fields["midas_point"] = depth_to_points(depths)
+    return fields
+
+def uses_rig(config):
+    return "obs3" in config["dataset"] or "obs3d" in config["dataset"]
+
+def rig_fields(config):
+    # per-camera fields needed besides obs3/obs3d: obs and obsd are not
+    # written next to them, and obs is only kept for goal_obs then
+    wanted = set(config["dataset"])
+    if "obs3" in wanted:
+        wanted.discard("obs")
+    if "obs3d" in wanted:
+        wanted.discard("obsd")
+    if "goal_obs" in wanted:
+        wanted.add("obs")
+    return wanted
+
+def convert_camera_rig(msgs, config, midas_ctx):
+    # the frames of one timestep are decoded straight into their thirds of
+    # one (N, H, 3W, 3) buffer, and MiDaS sees the three views of a timestep
+    # in the same batch; per-camera fields are views into obs3/obs3d
+    height, width = config["height"], config["width"]
+    wanted = rig_fields(config)
+    num = len(msgs[CAMERA_RIG[0]])
+    obs3 = np.empty((num, height, 3*width, 3), dtype=np.uint8)
+    for c, topic in enumerate(CAMERA_RIG):
+        convert_CompressedImage(msgs[topic], height, width, config.get("num_workers", 1), config.get("worker_backend", "thread"),
+                                config.get("reduced_decode", True), out=obs3[:, :, c*width:(c+1)*width])
+    fields = {}
+    if "obs3" in wanted:
+        fields["obs3"] = obs3
+    for c, topic in enumerate(CAMERA_RIG):
+        obs_name = CAMERA_FIELDS[topic][0]
+        if obs_name in wanted:
+            fields[obs_name] = obs3[:, :, c*width:(c+1)*width]
+    if midas_ctx is None:
+        return fields
+    midas, device, transform, depth_cache = midas_ctx
+    use_point = config["use_midas_point"]
+    use_depth = config["use_midas"] and ("obs3d" in wanted or any(CAMERA_FIELDS[topic][1] in wanted for topic in CAMERA_RIG))
+    if use_depth:
+        cameras = [0, 1, 2]
+    elif use_point:
+        cameras = [1]
+    else:
+        return fields
+    # timestep major, so a batch holds whole timesteps
+    views = [obs3[i, :, c*width:(c+1)*width] for i in range(num) for c in cameras]
+    keys = None
+    if depth_cache is not None:
+        keys = [depth_cache.key(msgs[CAMERA_RIG[c]][i].data, config["midas_type"], height, width)
+                for i in range(num) for c in cameras]
+    batch_size = -(-config.get("midas_batch_size", 1) // len(cameras)) * len(cameras)
+    depths = predict_depth_cached(views, midas, device, transform, height, width, batch_size, depth_cache, keys)
+    depths = depths.reshape(num, len(cameras), height, width)
+    if use_depth:
+        obs3d = depths.transpose(0, 2, 1, 3).reshape(num, height, 3*width) / np.float32(255)
+        if "obs3d" in wanted:
+            fields["obs3d"] = obs3d
+        for c, topic in enumerate(CAMERA_RIG):
+            obsd_name = CAMERA_FIELDS[topic][1]
+            if obsd_name in wanted:
+                fields[obsd_name] = obs3d[:, :, c*width:(c+1)*width]
+    if use_point:
+        fields["midas_point"] = depth_to_points(depths[:, cameras.index(1)])
+    return fields
+
+def convert_topics(rosbag_handler, sample_data, config, midas_ctx, state, timeline=None, grid=None):
+    # state carries values between consecutive chunks of the same view,
+    # timeline and grid are the whole bag and the tick times when known
+    dataset = {}
+    rig = []
+    if uses_rig(config) and all(topic in sample_data for topic in CAMERA_RIG):
+        print("==== convert camera rig ====")
+        rig = CAMERA_RIG
+        dataset.update(convert_camera_rig(sample_data, config, midas_ctx))
+    for topic in sample_data.keys():
+        if topic in rig:
+            continue
+        topic_type = rosbag_handler.get_topic_type(topic)
+        print(topic_type)
+        if topic_type == "sensor_msgs/CompressedImage":
+            if topic in CAMERA_FIELDS:
+                print("==== convert compressed image ====")
+                dataset.update(convert_camera(sample_data[topic], topic, config, midas_ctx))
+        elif topic_type == "sensor_msgs/Image":
+            print("==== convert image ====")
+            dataset["obs"] = convert_Image(sample_data[topic], config["height"], config["width"],
+                                           config.get("num_workers", 1), config.get("worker_backend", "thread"))
+        elif topic_type == "nav_msgs/Odometry":
+            print("==== convert odometry ====")
+            dataset['acs'], dataset['pos'] = \
+                convert_Odometry(sample_data[topic], config['action_noise'],
+                                    config['lower_bound'], config["upper_bound"])
+        elif topic_type == "geometry_msgs/Twist":
+            print("==== convert cmd_vel ====")
+            stream = None
+            if config.get("twist_dt") == "stamps" and timeline is not None and len(grid) > 0:
+                # every message is applied from its stamp until the next one,
+                # not only the commands selected for the ticks
+                times, values = timeline[topic]
+                stream = (times, values, grid)
+            dataset['acs'], dataset['pos'] = convert_Twist(sample_data[topic], config['action_noise'], config['lower_bound'], config["upper_bound"],
+                                                           hz=config["hz"], use_pose=True, init_pose=state.get("twist_pose"), stream=stream)
+            state["twist_pose"] = dataset['pos'][-1]
+        elif topic_type == "sensor_msgs/LaserScan":
+            print("==== convert laser scan ====")
+            dataset["lidar"] = convert_LaserScan(sample_data[topic])
+        elif topic_type == "sensor_msgs/Imu":
+            print("==== convert imu ====")
+            dataset["imu"] = convert_Imu(sample_data[topic])
+        elif topic_type == "geometry_msgs/PoseWithCovarianceStamped":
+            print("==== convert pose ====")
+            dataset["global_pos"] = convert_PoseWithCovarianceStamped(sample_data[topic])
+    return dataset
+
+def count_steps(dataset, config):
+    if "goal" in config["dataset"]:
+        num_steps = len(dataset["acs"]) - config["goal_steps"]
+    else:
+        num_steps = len(dataset["obs3"] if "obs3" in dataset else dataset["obs"])
+    # a bag shorter than goal_steps gives no trajectories, not a negative count
+    num_steps = max(0, num_steps)
+    num_traj = int(num_steps/config["traj_steps"])
+    return num_steps, num_traj
+
+def pose_outputs(dataset, config, num_traj):
+    # pose fields for all trajectories at once, (num_traj, steps, 3) each
+    outputs = {}
+    if "pos" in config["dataset"]:
+        outputs["pos"] = relative_trajectories(dataset["pos"], num_traj, config["traj_steps"])
+    if "global_pos" in config["dataset"]:
+        outputs["global_pos"] = relative_trajectories(dataset["global_pos"], num_traj, config["traj_steps"])
+    if "goal" in config["dataset"]:
+        outputs["goal"] = goal_trajectories(dataset["pos"], num_traj, config["traj_steps"], config["goal_steps"])
+    return outputs
+
+def stack_field(values):
+    # one contiguous array per field; lists of frames are copied once into a
+    # preallocated buffer instead of going through torch.tensor(list)
+    if isinstance(values, np.ndarray):
+        return np.ascontiguousarray(values)
+    if len(values) == 0:
+        return np.empty((0,))
+    first = np.asarray(values[0])
+    out = np.empty((len(values),) + first.shape, dtype=first.dtype)
+    for i, value in enumerate(values):
+        out[i] = value
+    return out
+
+def field_arrays(dataset, config, poses):
+    arrays = {}
+    for data_name in config["dataset"]:
+        if data_name == "goal_obs":
+            data_name = "obs"
+        if data_name in poses or data_name in arrays or data_name not in dataset:
+            continue
+        arrays[data_name] = stack_field(dataset[data_name])
+    return arrays
+
+def output_dtype(config, data_name):
+    # per-field dtype of the written tensors, e.g. {"obs": "uint8"}
+    return getattr(torch, config.get("output_dtypes", {}).get(data_name, "float32"))
+
+def to_tensor(array, dtype):
+    # a view of the bag-wide array unless the output dtype needs a cast
+    data = torch.from_numpy(array)
+    if data.dtype != dtype:
+        data = data.to(dtype)
+    return data
+
+def write_trajectory(writer, file_count, arrays, idx, config, poses):
+    t0 = idx*config["traj_steps"]
+    t1 = t0+config["traj_steps"]
+    for data_name in config["dataset"]:
+        if "obs3" in config["dataset"] and data_name == "obs":
+            continue
+        if "obs3d" in config["dataset"] and data_name == "obsd":
+            continue
+
+        with profiler.stage("to_tensor", items=1):
+            dtype = output_dtype(config, data_name)
+            if data_name in poses:
+                data = to_tensor(poses[data_name][idx], dtype)
+            elif data_name == "goal_obs":
+                # if (t1-1) < len(dataset["obs"]):
+                data = to_tensor(arrays["obs"][t1+config["goal_steps"]-1], dtype)
+            else:
+                data = to_tensor(arrays[data_name][t0:t1], dtype)
+
+        writer.write(file_count, data_name, data)
+
+def read_views(rosbag_handler, config):
+    # numeric topics are extracted into column arrays while reading so their
+    # messages are never kept
+    columns = {}
+    for topic in config["topics"]:
+        topic_type = rosbag_handler.get_topic_type(topic)
+        if topic_type in COLUMN_EXTRACTORS:
+            columns[topic] = make_column_buffer(topic_type)
+    timeline, views, grids = rosbag_handler.read_divided(topics=config["topics"], hz=config["hz"], divide_count=config["divide_count"],
+                                                          max_staleness=config.get("max_staleness"), columns=columns)
+    return timeline, views, grids, columns
+
+def convert_view(rosbag_handler, timeline, columns, view, grid, config, midas_ctx, skip=()):
+    # converts every topic of one resampled view except those in skip
+    sample_data = {}
+    for topic in view.keys():
+        if topic in skip:
+            continue
+        times, values = timeline[topic]
+        if topic in config.get("interpolate_topics", []) and topic in columns:
+            # linear interpolation onto the tick grid instead of the nearest message
+            angle_columns = ANGLE_COLUMNS.get(rosbag_handler.get_topic_type(topic), ())
+            sample_data[topic] = interpolate(times, values, grid, angle_columns)
+        else:
+            sample_data[topic] = select(values, view[topic])
+    return convert_topics(rosbag_handler, sample_data, config, midas_ctx, {}, timeline, grid)
+
+def convert_bag(rosbag_handler, writer, config, midas_ctx, resume_from=0):
+    divide_count = config["divide_count"]
+    traj_steps = config["traj_steps"]
+    timeline, views, grids, columns = read_views(rosbag_handler, config)
+    images = image_topics(rosbag_handler, config)
+
+    # trajectories written by an earlier run are skipped per view, so their
+    # frames are neither decoded nor passed through MiDaS again; every view
+    # index array has one entry per tick, like the converted fields
+    skips = []
+    file_count = 0
+    for grid in grids:
+        num_steps, num_traj = count_steps({"acs": grid, "obs": grid}, config)
+        skips.append(min(max(0, resume_from - file_count), num_traj))
+        file_count += num_traj
+    starts = [skip * traj_steps for skip in skips]
+
+    # decode the camera frames used by any of the views only once; the rig
+    # cameras are decoded per view into its obs3 buffer instead
+    frames = {}
+    for topic in images:
+        if topic not in CAMERA_FIELDS or rosbag_handler.get_topic_type(topic) != "sensor_msgs/CompressedImage":
+            continue
+        if uses_rig(config) and topic in CAMERA_RIG:
+            continue
+        used = sorted(set(i for view, start in zip(views, starts) for i in view[topic][start:]))
+        print("==== convert compressed image ====")
+        with profiler.stage("bag_read_lazy", items=len(used), io=True):
+            msgs = select(timeline[topic][1], used)
+        fields = convert_camera(msgs, topic, config, midas_ctx)
+        frames[topic] = (np.array(used, dtype=np.int64), {data_name: stack_field(values) for data_name, values in fields.items()})
+
+    file_count = 0
+    for view, grid, skip, start in zip(views, grids, skips, starts):
+        # numeric topics over the whole view, so action noise and Twist
+        # integration are the same as without resuming
+        dataset = convert_view(rosbag_handler, timeline, columns, view, grid, config, midas_ctx, images)
+        num_steps, num_traj = count_steps(dict(dataset, obs=grid), config)
+        poses = {data_name: values[skip:] for data_name, values in pose_outputs(dataset, config, num_traj).items()}
+        arrays = {data_name: values[start:] for data_name, values in field_arrays(dataset, config, poses).items()}
+
+        # image topics from the first tick still to be written
+        rest = {topic: view[topic][start:] for topic in images if topic not in frames}
+        dataset = convert_view(rosbag_handler, timeline, columns, rest, grid[start:], config, midas_ctx)
+        for topic, (used, fields) in frames.items():
+            position = np.searchsorted(used, view[topic][start:])
+            for data_name, values in fields.items():
+                dataset[data_name] = values[position]
+
+        print("==== save data as torch tensor ====")
+        arrays.update(field_arrays(dataset, config, poses))
+        del dataset
+        for idx in tqdm(range(num_traj - skip)):
+            write_trajectory(writer, file_count + skip + idx, arrays, idx, config, poses)
+        file_count += num_traj
+    return num_steps * divide_count, num_traj * divide_count
+
+def image_topics(rosbag_handler, config):
+    return [topic for topic in config["topics"]
+            if rosbag_handler.get_topic_type(topic) in ("sensor_msgs/CompressedImage", "sensor_msgs/Image")]
+
+# per segment worker process: open bags by path
+_segment_handlers = {}
+
+def convert_segment(job):
+    # decodes the images of one traj_steps aligned tick range and writes its
+    # trajectories; the numeric fields and poses come converted from the parent
+    bagfile, config, out_dir, indices, arrays, poses, file_count, num_traj, resume_from = job
+    from scheduler import get_midas_ctx
+    profiler.reset()
+    if bagfile not in _segment_handlers:
+        _segment_handlers[bagfile] = RosbagHandler(bagfile, cache_dir=bag_cache_dir_for(config))
+    rosbag_handler = _segment_handlers[bagfile]
+    sample_data = {}
+    for topic, topic_indices in indices.items():
+        with profiler.stage("bag_read_lazy", items=len(topic_indices), io=True):
+            sample_data[topic] = select(rosbag_handler.topic(topic), topic_indices)
+    dataset = convert_topics(rosbag_handler, sample_data, config, get_midas_ctx(config), {})
+    arrays = dict(arrays)
+    arrays.update(field_arrays(dataset, config, poses))
+    del dataset
+    writer = make_writer(out_dir, config)
+    for idx in range(num_traj):
+        if file_count + idx >= resume_from:
+            write_trajectory(writer, file_count + idx, arrays, idx, config, poses)
+    writer.close()
+    return profiler.summary()
+
+def convert_bag_parallel(rosbag_handler, writer, config, midas_ctx, out_dir):
+    # the numeric topics are read and converted here exactly as in
+    # convert_bag (so action noise and Twist integration see the whole view);
+    # image decoding, MiDaS, tensor assembly and writing run in worker
+    # processes on tick ranges aligned to traj_steps, overlapping by
+    # goal_steps where goal outputs look ahead
+    divide_count = config["divide_count"]
+    traj_steps = config["traj_steps"]
+    num_workers = config["segment_workers"]
+    if "goal" in config["dataset"] or "goal_obs" in config["dataset"]:
+        lookahead = config["goal_steps"]
+    else:
+        lookahead = 0
+    timeline, views, grids, columns = read_views(rosbag_handler, config)
+    images = image_topics(rosbag_handler, config)
+
+    jobs = []
+    file_count = 0
+    for view, grid in zip(views, grids):
+        dataset = convert_view(rosbag_handler, timeline, columns, view, grid, config, None, images)
+        # every view index array has one entry per tick, like the image fields
+        num_steps, num_traj = count_steps(dict(dataset, obs=grid), config)
+        poses = pose_outputs(dataset, config, num_traj)
+        arrays = field_arrays(dataset, config, poses)
+        del dataset
+        # a few segments per worker so uneven ones even out
+        segment_traj = max(1, -(-num_traj // (num_workers * 4)))
+        for a in range(0, num_traj, segment_traj):
+            b = min(a + segment_traj, num_traj)
+            if file_count + b <= writer.resume_from:
+                continue
+            s0 = a * traj_steps
+            s1 = min(b * traj_steps + lookahead, len(grid))
+            jobs.append((rosbag_handler.bagfile, config, out_dir,
+                         {topic: view[topic][s0:s1] for topic in images},
+                         {name: values[s0:s1] for name, values in arrays.items()},
+                         {name: values[a:b] for name, values in poses.items()},
+                         file_count + a, b - a, writer.resume_from))
+        file_count += num_traj
+
+    # spawn: CUDA cannot be re-initialized in a forked child
+    executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = {executor.submit(convert_segment, job): job for job in jobs}
+        done = {}
+        progress = jobs[0][6] if len(jobs) > 0 else 0
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            profiler.merge(future.result())
+            job = futures[future]
+            done[job[6]] = job[6] + job[7]
+            # the manifest only counts the leading segments that are all written
+            while progress in done:
+                progress = done.pop(progress)
+            if progress > writer.resume_from:
+                writer.manifest.progress(progress)
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return num_steps * divide_count, num_traj * divide_count
+
+def convert_chunks(rosbag_handler, chunks, config, midas_ctx, state):
+    for chunk in chunks:
+        state["num_ticks"] = state.get("num_ticks", 0) + len(chunk)
+        sample_data = {}
+        for topic in config["topics"]:
+            sample_data[topic] = [sample[topic] for sample in chunk]
+        dataset = convert_topics(rosbag_handler, sample_data, config, midas_ctx, state)
+        yield dataset
+
+def convert_bag_streaming(rosbag_handler, writer, config, midas_ctx):
+    # bag read -> resample -> convert -> write as a chain of generators; only
+    # about one trajectory (plus the goal_steps lookahead) is held in memory.
+    # each divide_count view re-reads the bag instead of keeping it in memory
+    for key in ("interpolate_topics", "twist_dt"):
+        # both need the whole message stream, which streaming never holds
+        if config.get(key):
+            raise ValueError("%s is not supported with streaming" % key)
+    divide_count = config["divide_count"]
+    divide_time = 1.0 / config["hz"] / divide_count
+    traj_steps = config["traj_steps"]
+    if "goal" in config["dataset"] or "goal_obs" in config["dataset"]:
+        lookahead = config["goal_steps"]
+    else:
+        lookahead = 0
+
+    file_count = 0
+    num_steps = 0
+    for each_divide_count in range(divide_count):
+        t0 = rosbag_handler.start_time + each_divide_count * divide_time
+        stream = rosbag_handler.iter_messages(config["topics"], start_time=t0)
+        samples = resample_stream(stream, config["topics"], config["hz"], config.get("max_staleness"))
+        chunks = chunked(samples, traj_steps)
+        state = {}
+        datasets = convert_chunks(rosbag_handler, chunks, config, midas_ctx, state)
+        for window in windows(datasets, traj_steps, lookahead):
+            poses = pose_outputs(window, config, 1)
+            write_trajectory(writer, file_count, field_arrays(window, config, poses), 0, config, poses)
+            file_count += 1
+        # counted like convert_bag counts a view
+        ticks = range(state.get("num_ticks", 0))
+        num_steps, _ = count_steps({"acs": ticks, "obs": ticks}, config)
+    return num_steps * divide_count, file_count
+
+def uses_segment_workers(config):
+    # the parallel path runs MiDaS in its workers; every other path needs
+    # midas_ctx from the caller
+    return (not config.get("streaming", False) and config.get("segment_workers", 1) > 1
+            and config.get("output_format", "pt") == "pt")
+
+def convert_bagfile(bagfile, config, midas_ctx, out_dir=None):
+    if not os.path.exists(bagfile):
+        raise ValueError('set bagfile')
+    if out_dir is None:
+        out_dir = output_dir_for(config, bagfile)
+    print("out_dir: ", out_dir)
+    manifest = Manifest(out_dir)
+    if manifest.is_complete(bagfile, config):
+        print("already converted: " + bagfile)
+        return None
+    resume_from = manifest.resume_from(bagfile, config)
+    if resume_from > 0:
+        print("resume from trajectory %d" % resume_from)
+    os.makedirs(out_dir, exist_ok=True)
+    for data_name in config["dataset"]:
+        os.makedirs(os.path.join(out_dir, data_name), exist_ok=True)
+    for data_name in config.get("jpeg_fields", []):
+        # frames of an earlier, unfinished run would be indexed twice
+        for path in glob.glob(os.path.join(glob.escape(out_dir), data_name, "frames_*")):
+            os.remove(path)
+    manifest.start(bagfile, config, resume_from)
+    profiler.reset()
+    hot_path = None
+    if config.get("cprofile", False):
+        hot_path = cProfile.Profile()
+        hot_path.enable()
+    rosbag_handler = RosbagHandler(bagfile, cache_dir=bag_cache_dir_for(config))
+    writer = ResumingWriter(make_writer(out_dir, config), manifest, resume_from)
+
+    if config.get("streaming", False):
+        num_steps, num_traj = convert_bag_streaming(rosbag_handler, writer, config, midas_ctx)
+    elif uses_segment_workers(config):
+        num_steps, num_traj = convert_bag_parallel(rosbag_handler, writer, config, midas_ctx, out_dir)
+    else:
+        num_steps, num_traj = convert_bag(rosbag_handler, writer, config, midas_ctx, resume_from)
+    writer.close()
+    if hot_path is not None:
+        hot_path.disable()
+        hot_path.dump_stats(os.path.join(out_dir, "profile.prof"))
+        pstats.Stats(hot_path).sort_stats("cumulative").print_stats(25)
+    summary = profiler.save(os.path.join(out_dir, "profile.json"), bagfile=bagfile,
+                            bag_bytes=os.path.getsize(bagfile), num_steps=num_steps, num_traj=num_traj)
+    print_summary(summary)
+    # only reached once every write has succeeded
+    info_path = os.path.join(out_dir, 'info.txt')
+    with open(info_path + '.tmp', 'w') as f:
+        info = dict(config)
+        info['num_steps'] = num_steps
+        info['num_traj'] = num_traj
+        json.dump(info, f)
+    os.replace(info_path + '.tmp', info_path)
+    manifest.complete(num_steps, num_traj)
+    return num_steps, num_traj
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str, default="config.json")
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--profile', action='store_true', help="dump a cProfile of each bag to <out_dir>/profile.prof")
+    parser.add_argument('--segment-workers', type=int, default=None, help="convert time ranges of each bag in this many processes")
     args = parser.parse_args()
 
     if os.path.exists(args.config):
@@ -19,168 +560,24 @@ if __name__ == '__main__':
             config = json.load(f)
     else:
         raise ValueError("cannot find config file")
+    if args.streaming:
+        config["streaming"] = True
+    if args.profile:
+        config["cprofile"] = True
+    if args.segment_workers is not None:
+        config["segment_workers"] = args.segment_workers
 
-    model_type = config["midas_type"]
-    use_midas = config["use_midas"]
-    use_midas_point = config["use_midas_point"]
-    divide_count = config["divide_count"]
-    hz = config["hz"]
-    divide_time = 1.0 / hz /divide_count
-
-    if use_midas or use_midas_point:
-        midas = torch.hub.load("intel-isl/MiDaS", model_type)
-        midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        midas.to(device)
-        midas.eval()
-
-        if model_type == "DPT_Large" or model_type == "DPT_Hybrid":
-            transform = midas_transforms.dpt_transform
-        else:
-            transform = midas_transforms.small_transform
+    midas_ctx = None
+    if (config["use_midas"] or config["use_midas_point"]) and not uses_segment_workers(config):
+        midas_ctx = load_midas(config)
 
     for bagfile_name in config["bagfile_name"]:
-        bagfile = os.path.join(config["bagfile_dir"], bagfile_name)
-        if not os.path.exists(bagfile):
-            raise ValueError('set bagfile')
-        file_name = os.path.splitext(os.path.basename(bagfile))[0]+"_traj"+str(config["traj_steps"])
-        out_dir = os.path.join(config["output_dir"], file_name)
-        print("out_dir: ", out_dir)
-        os.makedirs(out_dir, exist_ok=True)
-        for data_name in config["dataset"]:
-            os.makedirs(os.path.join(out_dir, data_name), exist_ok=True)
-        rosbag_handler = RosbagHandler(bagfile)
-
-        file_count = 0
-        for each_divide_count in range(divide_count):
-            t0 = rosbag_handler.start_time + each_divide_count * divide_time
-            t1 = rosbag_handler.end_time
-            sample_data = rosbag_handler.read_messages(topics=config["topics"], start_time=t0, end_time=t1, hz=config["hz"])
-            dataset = {}
-            for topic in sample_data.keys():
-                topic_type = rosbag_handler.get_topic_type(topic)
-                print(topic_type)
-                if topic_type == "sensor_msgs/CompressedImage":
-                    print("==== convert compressed image ====")
-                    if topic == "camera/color/image_raw/compressed":
-                        dataset["obs"] = convert_CompressedImage(sample_data[topic], config["height"], config["width"])
-                        if use_midas:
-                            dataset["obsd"] = convert_CompressedImage_depth(dataset["obs"], midas, device, transform, config["height"], config["width"])
-                        if use_midas_point:
-                            dataset["midas_point"] = convert_CompressedImage_depth2point(dataset["obs"], midas, device, transform, config["height"], config["width"])
-
-                    if topic == "front_right_camera/color/image_raw/compressed":
-                        dataset["obsright"] = convert_CompressedImage(sample_data[topic], config["height"], config["width"])
-
-                        if use_midas:
-                            dataset["obsrightd"] = convert_CompressedImage_depth(dataset["obsright"], midas, device, transform, config["height"], config["width"])
-
-                    if topic == "front_left_camera/color/image_raw/compressed":
-                        dataset["obsleft"] = convert_CompressedImage(sample_data[topic], config["height"], config["width"])
-
-                        if use_midas:
-                            dataset["obsleftd"] = convert_CompressedImage_depth(dataset["obsleft"], midas , device, transform, config["height"], config["width"])
-
-                elif topic_type == "":
-                    print("==== convert image ====")
-                    dataset["obs"] = convert_Image(sample_data[topic], config["height"], config["width"])
-                elif topic_type == "nav_msgs/Odometry":
-                    print("==== convert odometry ====")
-                    dataset['acs'], dataset['pos'] = \
-                        convert_Odometry(sample_data[topic], config['action_noise'],
-                                            config['lower_bound'], config["upper_bound"])
-                elif topic_type == "geometry_msgs/Twist":
-                    print("==== convert cmd_vel ====")
-                    dataset['acs'], dataset['pos'] = convert_Twist(sample_data[topic], config['action_noise'], config['lower_bound'], config["upper_bound"], hz=config["hz"], use_pose=True)
-                elif topic_type == "sensor_msgs/LaserScan":
-                    print("==== convert laser scan ====")
-                    dataset["lidar"] = convert_LaserScan(sample_data[topic])
-                elif topic_type == "sensor_msgs/Imu":
-                    print("==== convert imu ====")
-                    dataset["imu"] = convert_Imu(sample_data[topic])
-                elif topic_type == "geometry_msgs/PoseWithCovarianceStamped":
-                    print("==== convert pose ====")
-                    dataset["global_pos"] = convert_PoseWithCovarianceStamped(sample_data[topic])
-
-            print("==== save data as torch tensor ====")
-            if "goal" in config["dataset"]:
-                num_steps = len(dataset["acs"]) - config["goal_steps"]
-            else:
-                num_steps = len(dataset["obs"])
-            num_traj = int(num_steps/config["traj_steps"])
-
-            use_obs3_img_flag = False
-            use_obs3d_img_flag = False
-
-            for data_name in config["dataset"]:
-                if data_name == "obs3":
-                    use_obs3_img_flag = True
-                    concat_imgs = []
-                    for obs_front, obs_right, obs_left in zip(dataset["obs"], dataset["obsright"], dataset["obsleft"]):
-                        concat_img = cv2.hconcat([obs_left, obs_front, obs_right])
-                        concat_imgs.append(concat_img)
-                    dataset["obs3"] = concat_imgs
-
-                if data_name == "obs3d":
-                    use_obs3d_img_flag = True
-                    concat_imgs = []
-                    for obs_front, obs_right, obs_left in zip(dataset["obsd"], dataset["obsrightd"], dataset["obsleftd"]):
-                        concat_img = cv2.hconcat([obs_left, obs_front, obs_right])
-                        concat_imgs.append(concat_img)
-                    dataset["obs3d"] = concat_imgs
-
-            for idx in tqdm(range(num_traj)):
-                file_name = ("%d.pt" % (file_count))
-                t0 = idx*config["traj_steps"]
-                t1 = t0+config["traj_steps"]
-                for data_name in config["dataset"]:
-                    path = os.path.join(out_dir, data_name, file_name)
-
-                    if use_obs3_img_flag and data_name == "obs":
-                        continue
-                    if use_obs3d_img_flag and data_name == "obsd":
-                        continue
-
-                    if data_name == "pos":
-                        traj_pos = dataset["pos"][t0:t1]
-                        poses = []
-                        init_pose = traj_pos[0].copy()
-                        for idx, pose in enumerate(traj_pos):
-                            trans_pose = transform_pose(pose, init_pose)
-                            poses.append(trans_pose)
-                        data = torch.tensor(poses, dtype=torch.float32)
-
-                    elif data_name == "global_pos":
-                        traj_pos = dataset["global_pos"][t0:t1]
-                        poses = []
-                        init_pose = traj_pos[0].copy()
-                        for idx, pose in enumerate(traj_pos):
-                            trans_pose = transform_pose(pose, init_pose)
-                            poses.append(trans_pose)
-                        data = torch.tensor(poses, dtype=torch.float32)
-
-                    elif data_name == "goal":
-                        traj_pos = dataset["pos"][t0:t1+config["goal_steps"]]
-
-                        goals = []
-                        for idx, pose in enumerate(traj_pos):
-                            # if (idx+config["goal_steps"]) < len(traj_pos) and len(dataset["obs"]) > (t1+config["goal_steps"]):
-                            goal = transform_pose(traj_pos[-1], pose)
-                            goals.append(goal)
-                        data = torch.tensor(goals, dtype=torch.float32)
-                    elif data_name == "goal_obs":
-                        # if (t1-1) < len(dataset["obs"]):
-                        traj_goal_obs = dataset["obs"][t1+config["goal_steps"]-1]
-                        data = torch.tensor(traj_goal_obs, dtype=torch.float32)
-                    else:
-                        traj_data = dataset[data_name][t0:t1]
-                        data = torch.tensor(traj_data, dtype=torch.float32)
-
-                    with open(path, "wb") as f:
-                        torch.save(data, f)
-                file_count += 1
-        with open(os.path.join(out_dir, 'info.txt'), 'w') as f:
-            info = config
-            info['num_steps'] = num_steps * divide_count
-            info['num_traj'] = num_traj * divide_count
-            json.dump(info, f)
+        convert_bagfile(os.path.join(config["bagfile_dir"], bagfile_name), config, midas_ctx)
+
+    if midas_ctx is not None and midas_ctx[3] is not None:
+        midas_ctx[3].report()
+    # ru_maxrss is in kilobytes on Linux
+    print("peak rss: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+if __name__ == '__main__':
+    main()
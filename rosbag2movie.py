@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import os
-import shutil
 import argparse
 
 import cv2
 
 from rosbaghandler import RosbagHandler
+from mjpeg import MjpegAviWriter
 from utils import *
 
 def main():
@@ -16,45 +16,46 @@ def main():
     parser.add_argument('--output-dir', type=str)
     parser.add_argument('--frame-rate', type=float)
     parser.add_argument('--save-img-dir', type=str)
+    parser.add_argument('--mjpeg', action='store_true',
+                        help="copy JPEG frames of a CompressedImage topic into an MJPEG .avi without re-encoding")
     args = parser.parse_args()
 
     rosbag_handler = RosbagHandler(args.bagfile)
+    topic_type = rosbag_handler.get_topic_type(args.image_topic)
+    file_name = os.path.splitext(os.path.basename(args.bagfile))[0]
+    output_path = os.path.join(args.output_dir, file_name+"-"+args.image_topic.replace('/','_')+".mp4")
 
-    t0 = rosbag_handler.start_time
-    dt = 100
-    os.makedirs("/tmp/" + str(args.bagfile), exist_ok=True)
-
-    idx = 0
-    while t0<rosbag_handler.end_time:
-        t1 = t0 + dt
-        if t1>rosbag_handler.end_time:
-            t1 = rosbag_handler.end_time
-
-        data = rosbag_handler.read_messages(topics=[args.image_topic],
-                start_time=t0, end_time=t1)
-        img_data = data[args.image_topic]
-        topic_type = rosbag_handler.get_topic_type(args.image_topic)
+    # frames go straight from the bag into the encoder as they are read
+    out = None
+    mjpeg = args.mjpeg and topic_type == "sensor_msgs/CompressedImage"
+    for _, _, msg in rosbag_handler.iter_messages(topics=[args.image_topic]):
+        if mjpeg:
+            data = msg.data
+            if "jpeg" not in msg.format.lower():
+                # e.g. a png frame; re-encoded so the stream stays MJPEG
+                print("re-encoding %s frame as JPEG" % msg.format)
+                ok, data = cv2.imencode(".jpg", decode_CompressedImage(msg))
+                if not ok:
+                    raise ValueError("cannot encode %s frame as JPEG" % msg.format)
+            if out is None:
+                img = decode_CompressedImage(msg)
+                h,w,c = img.shape
+                output_path = os.path.splitext(output_path)[0] + ".avi"
+                print("output_path: ", output_path)
+                out = MjpegAviWriter(output_path, args.frame_rate, w, h)
+            out.write(data)
+            continue
         if topic_type == "sensor_msgs/CompressedImage":
-            images = convert_CompressedImage(img_data)
+            img = decode_CompressedImage(msg)
         elif topic_type == "sensor_msgs/Image":
-            images = convert_Image(img_data)
-        for img in images:
-            cv2.imwrite(os.path.join("/tmp/" + str(args.bagfile), str(idx)+".png"), img)
-            idx+=1
-        t0 = t1
-
-    # img = cv2.imread("/tmp/rosbag2dataset/0.png")
-    img = cv2.imread("/tmp/" + str(args.bagfile) + "/0.png")
-    h,w,c = img.shape
-    file_name = os.path.splitext(os.path.basename(args.bagfile))[0]
-    output_path = os.path.join(args.output_dir, file_name+"-"+args.image_topic.replace('/','_')+".mp4")
-    print("output_path: ", output_path)
-    out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc('m','p','4','v'), args.frame_rate, (w,h))
-    for idx in range(len(os.listdir("/tmp/" + str(args.bagfile)))):
-        img = cv2.imread(os.path.join("/tmp/" + str(args.bagfile), str(idx)+".png"))
+            img = decode_Image(msg)
+        if out is None:
+            h,w,c = img.shape
+            print("output_path: ", output_path)
+            out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc('m','p','4','v'), args.frame_rate, (w,h))
         out.write(img)
-    out.release()
-    shutil.rmtree("/tmp/" + str(args.bagfile))
+    if out is not None:
+        out.release()
 
 if __name__=="__main__":
     main()
@@ -1,52 +1,290 @@
+import os
+import json
+import time
+import uuid
+import hashlib
 import collections
 import numpy as np
 
 import rospy
 import rosbag
 
+from resampler import resample, select
+from profiler import profiler, io_counters
+
+
+class TopicView:
+    # lazy, index-backed sequence of the messages of one topic; a message is
+    # only read and deserialized when it is accessed
+    def __init__(self, bag, times, positions):
+        self.bag = bag
+        self.times = times
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        chunk_pos, offset = self.positions[i]
+        return self.bag._read_message((int(chunk_pos), int(offset))).message
+
+    def index_at(self, t):
+        i = int(np.searchsorted(self.times, t))
+        if i == len(self.times) or (i > 0 and t - self.times[i-1] <= self.times[i] - t):
+            i -= 1
+        return i
+
+    def at(self, t):
+        # message nearest to bag time t
+        return self[self.index_at(t)]
+
+    def between(self, start_time, end_time):
+        i0 = int(np.searchsorted(self.times, start_time, side="left"))
+        i1 = int(np.searchsorted(self.times, end_time, side="right"))
+        return self[i0:i1]
+
+
+TopicTuple = collections.namedtuple("TopicTuple", ["msg_type", "message_count", "connections", "frequency"])
+TypesAndTopicsTuple =  collections.namedtuple("TypesAndTopicsTuple", ["msg_types", "topics"])
+
 
 class RosbagHandler:
-    def __init__(self, bagfile):
+    def __init__(self, bagfile, verbose=False, cache_dir=None):
         print('bagfile: ' + bagfile)
-        try:
-            self.bag = rosbag.Bag(bagfile)
-        except Exception as e:
-            rospy.logfatal('failed to load bag file:%s', e)
-            exit(1)
-        TopicTuple = collections.namedtuple("TopicTuple", ["msg_type", "message_count", "connections", "frequency"])
-        TypesAndTopicsTuple =  collections.namedtuple("TypesAndTopicsTuple", ["msg_types", "topics"])
-        self.info = self.bag.get_type_and_topic_info()
-        for topic, topic_info in self.info.topics.items():
-            print("======================================================")
-            print("topic_name:      " + topic)
-            print("topic_msg_type:  " + topic_info.msg_type)
-            print("topic_msg_count: " + str(topic_info.message_count))
-            print("frequency:       " + str(topic_info.frequency))
-        self.start_time = self.bag.get_start_time()
-        self.end_time = self.bag.get_end_time()
+        self.bagfile = bagfile
+        self.cache_dir = cache_dir
+        self.index = None
+        self._bag = None
+        # topic/type/frequency info and start/end times are cached in
+        # cache_dir, so re-opening a known bag does not parse it until
+        # messages are read; nothing is cached without a cache_dir
+        cached = self.load_info()
+        if cached is None:
+            self.info = self.bag.get_type_and_topic_info()
+            self.start_time = self.bag.get_start_time()
+            self.end_time = self.bag.get_end_time()
+            self.save_info()
+        else:
+            self.info, self.start_time, self.end_time = cached
+        if verbose:
+            for topic, topic_info in self.info.topics.items():
+                print("======================================================")
+                print("topic_name:      " + topic)
+                print("topic_msg_type:  " + topic_info.msg_type)
+                print("topic_msg_count: " + str(topic_info.message_count))
+                print("frequency:       " + str(topic_info.frequency))
         print("start time: " + str(self.start_time))
         print("end time:   " + str(self.end_time))
 
+    @property
+    def bag(self):
+        if self._bag is None:
+            try:
+                with profiler.stage("bag_open", io=True):
+                    self._bag = rosbag.Bag(self.bagfile)
+            except Exception as e:
+                rospy.logfatal('failed to load bag file:%s', e)
+                # an exception, not exit(): a SystemExit would kill a pool
+                # worker and leave its job's result pending forever
+                raise RuntimeError("failed to load bag file %s: %s" % (self.bagfile, e)) from e
+        return self._bag
+
+    def cache_path(self, suffix):
+        # bag directories may be read-only or shared, so the sidecar files
+        # go to cache_dir, named after the bag and a hash of its full path
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(os.path.abspath(self.bagfile).encode()).hexdigest()[:8]
+        return os.path.join(self.cache_dir, "%s.%s%s" % (os.path.basename(self.bagfile), digest, suffix))
+
+    def write_cache(self, suffix, save):
+        # save(tmp_path) writes the file, renamed into place atomically; the
+        # temporary name is unique across hosts sharing cache_dir
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self.cache_path(".%s.tmp%s" % (uuid.uuid4().hex, suffix))
+            save(tmp_path)
+            os.replace(tmp_path, self.cache_path(suffix))
+        except OSError as e:
+            print("cannot write %s: %s" % (self.cache_path(suffix), e))
+
+    def info_path(self):
+        return self.cache_path(".info.json")
+
+    def load_info(self):
+        if self.cache_dir is None:
+            return None
+        try:
+            stat = os.stat(self.bagfile)
+            with open(self.info_path(), "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("size") != stat.st_size or cached.get("mtime") != stat.st_mtime:
+            return None
+        topics = {}
+        for topic, topic_info in cached["topics"].items():
+            topics[topic] = TopicTuple(topic_info["msg_type"], topic_info["message_count"],
+                                       topic_info["connections"], topic_info["frequency"])
+        info = TypesAndTopicsTuple(cached["msg_types"], topics)
+        return info, cached["start_time"], cached["end_time"]
+
+    def save_info(self):
+        stat = os.stat(self.bagfile)
+        cached = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "msg_types": dict(self.info.msg_types),
+            "topics": {topic: {"msg_type": topic_info.msg_type,
+                               "message_count": topic_info.message_count,
+                               "connections": topic_info.connections,
+                               "frequency": topic_info.frequency}
+                       for topic, topic_info in self.info.topics.items()},
+        }
+        def save(path):
+            with open(path, "w") as f:
+                json.dump(cached, f)
+        self.write_cache(".info.json", save)
+
     def read_messages(self, topics=None, start_time=None, end_time=None, hz=None):
+        data = self.read_timeline(topics, start_time, end_time)
+        if hz is not None:
+            return self.convert_data(data, hz)
+        for topic in data.keys():
+            data[topic] = data[topic][1]
+        return data
+
+    def read_timeline(self, topics=None, start_time=None, end_time=None, columns=None):
+        # {topic: (stamps, messages)}; for topics with a ColumnBuffer in
+        # columns the messages are pushed into it and only its array is kept
+        if columns is None:
+            columns = {}
+        times = {}
+        values = {}
+        for topic in topics:
+            times[topic] = []
+            values[topic] = []
+        for topic, stamp, msg in self.iter_messages(topics, start_time, end_time):
+            times[topic].append(stamp)
+            if topic in columns:
+                columns[topic].push(msg)
+            else:
+                values[topic].append(msg)
+        data = {}
+        for topic in topics:
+            if topic in columns:
+                values[topic] = columns[topic].array()
+            data[topic] = (np.array(times[topic], dtype=np.float64), values[topic])
+        return data
+
+    def iter_messages(self, topics=None, start_time=None, end_time=None):
         if start_time is None:
             start_time = self.start_time
         if end_time is None:
             end_time = self.end_time
         start_time = rospy.Time.from_seconds(start_time)
         end_time = rospy.Time.from_seconds(end_time)
-        data = {}
         topic_names = []
         for topic in topics:
-            data[topic] = []
             topic_names.append("/"+topic)
-        for topic, msg, time in self.bag.read_messages(topics=topic_names, start_time=start_time, end_time=end_time):
-            if hz is not None:
-                data[topic[1:]].append([time.to_nsec()/1e9, msg])
-            else:
-                data[topic[1:]].append(msg)
-        if hz is not None:
-            data = self.convert_data(data, hz)
-        return data
+        # only the time spent inside rosbag counts as bag_read, not the time
+        # the consumer takes between messages
+        messages = self.bag.read_messages(topics=topic_names, start_time=start_time, end_time=end_time)
+        seconds = 0.0
+        count = 0
+        rchar, _ = io_counters()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    topic, msg, stamp = next(messages)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                count += 1
+                yield topic[1:], stamp.to_nsec()/1e9, msg
+        finally:
+            profiler.add("bag_read", seconds, count, bytes_read=io_counters()[0] - rchar)
+
+    def read_divided(self, topics, hz, divide_count, max_staleness=None, columns=None):
+        # read and deserialize the bag once, then resample it divide_count times
+        # with the start shifted by 1/hz/divide_count for each view.
+        # only topics with columns are read up front, the others are lazy
+        # TopicViews so only the messages a view selects get deserialized
+        if columns is None:
+            columns = {}
+        timeline = {}
+        if len(columns) > 0:
+            timeline = self.read_timeline([topic for topic in topics if topic in columns], columns=columns)
+        for topic in topics:
+            if topic not in columns:
+                view = self.topic(topic)
+                timeline[topic] = (view.times, view)
+        times = self.timestamps(timeline)
+        divide_time = 1.0 / hz / divide_count
+        views = []
+        grids = []
+        for each_divide_count in range(divide_count):
+            t0 = self.start_time + each_divide_count * divide_time
+            grid, indices = resample(times, hz, start_time=t0, max_staleness=max_staleness)
+            views.append(indices)
+            grids.append(grid)
+        return timeline, views, grids
+
+    def timestamps(self, data):
+        times = {}
+        for topic in data.keys():
+            times[topic] = data[topic][0]
+        return times
+
+    def topic(self, topic_name):
+        if self.index is None:
+            self.index = self.load_index()
+        times, positions = self.index[topic_name]
+        return TopicView(self.bag, times, positions)
+
+    def index_path(self):
+        return self.cache_path(".index.npz")
+
+    def load_index(self):
+        with profiler.stage("bag_index", io=True):
+            return self.build_index()
+
+    def build_index(self):
+        # per-topic stamps and (chunk_pos, offset) of every message, from the
+        # bag's own index; cached in cache_dir keyed by its size and mtime
+        stat = os.stat(self.bagfile)
+        if self.cache_dir is not None and os.path.exists(self.index_path()):
+            try:
+                with np.load(self.index_path()) as f:
+                    if f["size"] == stat.st_size and f["mtime"] == stat.st_mtime:
+                        index = {}
+                        for n, topic in enumerate(f["topics"]):
+                            index[str(topic)] = (f["times_%d" % n], f["positions_%d" % n])
+                        return index
+            except (OSError, ValueError, KeyError):
+                pass
+        index = {}
+        arrays = {"size": stat.st_size, "mtime": stat.st_mtime}
+        topics = [topic[1:] for topic in self.info.topics.keys()]
+        for n, topic in enumerate(topics):
+            times = []
+            positions = []
+            for entry in self.bag._get_entries(self.bag._get_connections(topics=["/"+topic])):
+                times.append(entry.time.to_nsec()/1e9)
+                positions.append((entry.chunk_pos, entry.offset))
+            index[topic] = (np.array(times, dtype=np.float64), np.array(positions, dtype=np.int64).reshape(-1, 2))
+            arrays["times_%d" % n], arrays["positions_%d" % n] = index[topic]
+        arrays["topics"] = np.array(topics)
+        self.write_cache(".index.npz", lambda path: np.savez(path, **arrays))
+        return index
 
     def get_topic_type(self, topic_name):
         topic_type = None
@@ -56,25 +294,14 @@ class RosbagHandler:
         return topic_type
 
     def convert_data(self, data, hz):
+        idx = self.sample_indices(data, hz)
         data_ = {}
-        start_time = 0
-        end_time = np.inf
-        idx = {}
         for topic in data.keys():
-            start_time = max(start_time, data[topic][0][0])
-            end_time = min(end_time, data[topic][-1][0])
-            data_[topic] = []
-            idx[topic] = 1
-        t = start_time
-        while(t<end_time):
-            for topic in data.keys():
-                cnt = 0
-                while(data[topic][idx[topic]][0]<t):
-                    cnt+=1
-                    idx[topic]+=1
-                if (data[topic][idx[topic]][0]-t<t-data[topic][idx[topic]-1][0]):
-                    data_[topic].append(data[topic][idx[topic]][1])
-                else:
-                    data_[topic].append(data[topic][idx[topic]-1][1])
-            t+=1./hz
+            data_[topic] = select(data[topic][1], idx[topic])
         return data_
+
+    def sample_indices(self, data, hz, start_time=None, max_staleness=None):
+        # messages stamped before start_time are ignored, as if the bag had been
+        # read from start_time
+        _, indices = resample(self.timestamps(data), hz, start_time=start_time, max_staleness=max_staleness)
+        return indices
@@ -0,0 +1,85 @@
+import os
+import time
+import traceback
+import multiprocessing
+
+from rosbag2dataset import convert_bagfile, load_midas, uses_segment_workers
+from claim import convert_claimed
+
+
+# per worker process: MiDaS models keyed by (midas_type, depth_cache_dir),
+# loaded on the first job that needs them and reused for every later job
+_midas_ctxs = {}
+
+def uses_midas(config):
+    return config["use_midas"] or config["use_midas_point"]
+
+def get_midas_ctx(config):
+    if not uses_midas(config):
+        return None
+    key = (config["midas_type"], config.get("depth_cache_dir"))
+    if key not in _midas_ctxs:
+        _midas_ctxs[key] = load_midas(config)
+    return _midas_ctxs[key]
+
+def run_job(job):
+    bagfile, config = job
+    start = time.perf_counter()
+    try:
+        # with segment workers MiDaS runs in the workers only
+        midas_ctx = None if uses_segment_workers(config) else get_midas_ctx(config)
+        if config.get("claim_leases", False):
+            result = convert_claimed(bagfile, config, midas_ctx)
+        else:
+            result = convert_bagfile(bagfile, config, midas_ctx)
+        return bagfile, time.perf_counter() - start, result, None
+    except (Exception, SystemExit):
+        # SystemExit too, it would otherwise end the pool worker and the
+        # result of this job would never arrive
+        return bagfile, time.perf_counter() - start, None, traceback.format_exc()
+
+def schedule(jobs, num_cpu=1, num_gpu=1):
+    # jobs: [(bagfile, config)]; MiDaS jobs run on their own pool of num_gpu
+    # workers so CPU-only bags are not throttled by (or starve) the GPU.
+    # biggest bags go first so a large one does not finish alone at the end
+    jobs = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+    gpu_jobs = [job for job in jobs if uses_midas(job[1])]
+    cpu_jobs = [job for job in jobs if not uses_midas(job[1])]
+
+    # spawn: CUDA cannot be re-initialized in a forked child
+    ctx = multiprocessing.get_context("spawn")
+    pools = []
+    pending = []
+    for pool_jobs, num_workers in [(gpu_jobs, num_gpu), (cpu_jobs, num_cpu)]:
+        if len(pool_jobs) == 0:
+            continue
+        pool = ctx.Pool(num_workers)
+        pools.append(pool)
+        for job in pool_jobs:
+            pending.append(pool.apply_async(run_job, (job,)))
+
+    results = []
+    try:
+        for async_result in pending:
+            bagfile, elapsed, result, error = async_result.get()
+            results.append((bagfile, elapsed, result, error))
+            if error is not None:
+                print("==== failed: %s (%.1f s) ====" % (bagfile, elapsed))
+                print(error)
+            elif result is None:
+                print("==== skipped: %s ====" % bagfile)
+            else:
+                print("==== done: %s (%.1f s, %d trajectories) ====" % (bagfile, elapsed, result[1]))
+    finally:
+        for pool in pools:
+            pool.close()
+        for pool in pools:
+            pool.join()
+
+    print("\n" + "==== Summary ====" + "\n")
+    for bagfile, elapsed, result, error in sorted(results, key=lambda r: -r[1]):
+        status = "failed" if error is not None else ("skipped" if result is None else "ok")
+        print("%8.1f s  %-7s  %s" % (elapsed, status, os.path.basename(bagfile)))
+    failures = [r for r in results if r[3] is not None]
+    print("%d bags, %d failed" % (len(results), len(failures)))
+    return results
@@ -0,0 +1,63 @@
+import collections
+
+
+def resample_stream(stream, topics, hz, max_staleness=None):
+    # streaming counterpart of resampler.resample: consumes (topic, time, msg)
+    # in bag order and yields {topic: msg} per tick as soon as every topic has
+    # a message after the tick, keeping only the messages that can still be
+    # the nearest one to a future tick
+    buffers = {}
+    for topic in topics:
+        buffers[topic] = collections.deque()
+    grid_start = None
+    k = 0
+    for topic, t, msg in stream:
+        buffers[topic].append((t, msg))
+        if grid_start is None:
+            if min(len(buffer) for buffer in buffers.values()) == 0:
+                continue
+            grid_start = max(buffer[0][0] for buffer in buffers.values())
+        while True:
+            tick = grid_start + k / hz
+            if not all(buffer[-1][0] > tick for buffer in buffers.values()):
+                break
+            sample = {}
+            stale = False
+            for name, buffer in buffers.items():
+                while len(buffer) > 1 and buffer[1][0] < tick:
+                    buffer.popleft()
+                if buffer[0][0] >= tick or buffer[1][0]-tick >= tick-buffer[0][0]:
+                    nearest = buffer[0]
+                else:
+                    nearest = buffer[1]
+                if max_staleness is not None and abs(nearest[0]-tick) > max_staleness:
+                    stale = True
+                sample[name] = nearest[1]
+            k += 1
+            if not stale:
+                yield sample
+
+def chunked(samples, size):
+    chunk = []
+    for sample in samples:
+        chunk.append(sample)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def windows(datasets, traj_steps, lookahead=0):
+    # concatenates converted chunks ({data_name: list}) and yields each
+    # trajectory window of traj_steps + lookahead steps once it is complete,
+    # holding at most one window plus one chunk in memory
+    buffer = {}
+    for dataset in datasets:
+        for data_name, values in dataset.items():
+            buffer.setdefault(data_name, []).extend(values)
+        while buffer and min(len(values) for values in buffer.values()) >= traj_steps + lookahead:
+            window = {}
+            for data_name, values in buffer.items():
+                window[data_name] = values[:traj_steps+lookahead]
+                del values[:traj_steps]
+            yield window
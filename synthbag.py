@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+
+import numpy as np
+import cv2
+
+import rospy
+import rosbag
+from sensor_msgs.msg import CompressedImage, Image, LaserScan, Imu
+from nav_msgs.msg import Odometry
+from geometry_msgs.msg import Twist, PoseWithCovarianceStamped
+
+
+def make_image(rng, width, height, k):
+    # smooth gradient plus noise, so JPEG sizes are closer to a camera's than pure noise
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.stack([x + 0*y, y + 0*x, (x + y + 8*k) % 256], axis=-1)
+    img += rng.normal(0, 8, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def camera_msgs(rng, args):
+    for k, t in enumerate(np.arange(0.0, args.duration, 1.0/args.camera_hz)):
+        msg = CompressedImage()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.format = "jpeg"
+        msg.data = cv2.imencode(".jpg", make_image(rng, args.width, args.height, k))[1].tobytes()
+        yield t, "/camera/color/image_raw/compressed", msg
+
+def raw_camera_msgs(rng, args):
+    if args.raw_camera_hz <= 0:
+        return
+    for k, t in enumerate(np.arange(0.0, args.duration, 1.0/args.raw_camera_hz)):
+        msg = Image()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.height = args.height
+        msg.width = args.width
+        msg.encoding = "bgr8"
+        msg.step = 3*args.width
+        msg.data = make_image(rng, args.width, args.height, k).tobytes()
+        yield t, "/camera/color/image_raw", msg
+
+def scan_msgs(rng, args):
+    for t in np.arange(0.0, args.duration, 1.0/args.scan_hz):
+        msg = LaserScan()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.angle_min = -np.pi
+        msg.angle_max = np.pi
+        msg.angle_increment = 2*np.pi/args.beams
+        msg.range_max = 30.0
+        msg.ranges = list(rng.uniform(0.1, 30.0, args.beams).astype(np.float32))
+        yield t, "/front_laser/scan", msg
+
+def odom_msgs(rng, args):
+    x, y, yaw = 0.0, 0.0, 0.0
+    dt = 1.0/args.odom_hz
+    for t in np.arange(0.0, args.duration, dt):
+        v = 0.8 + 0.2*np.sin(0.1*t)
+        w = 0.3*np.sin(0.05*t)
+        x += v*np.cos(yaw)*dt
+        y += v*np.sin(yaw)*dt
+        yaw += w*dt
+        msg = Odometry()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.pose.pose.position.x = x
+        msg.pose.pose.position.y = y
+        msg.pose.pose.orientation.z = np.sin(yaw/2)
+        msg.pose.pose.orientation.w = np.cos(yaw/2)
+        msg.twist.twist.linear.x = v
+        msg.twist.twist.angular.z = w
+        yield t, "/odom", msg
+
+def cmd_vel_msgs(rng, args):
+    for t in np.arange(0.0, args.duration, 1.0/args.cmd_vel_hz):
+        msg = Twist()
+        msg.linear.x = 0.8 + 0.2*np.sin(0.1*t)
+        msg.angular.z = 0.3*np.sin(0.05*t)
+        yield t, "/cmd_vel", msg
+
+def pose_msgs(rng, args):
+    # noisy localization estimate along a circle
+    for t in np.arange(0.0, args.duration, 1.0/args.pose_hz):
+        yaw = 0.05*t
+        msg = PoseWithCovarianceStamped()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.header.frame_id = "map"
+        msg.pose.pose.position.x = 10*np.sin(yaw) + rng.normal(0, 0.02)
+        msg.pose.pose.position.y = 10*(1 - np.cos(yaw)) + rng.normal(0, 0.02)
+        msg.pose.pose.orientation.z = np.sin(yaw/2)
+        msg.pose.pose.orientation.w = np.cos(yaw/2)
+        yield t, "/amcl_pose", msg
+
+def imu_msgs(rng, args):
+    for t in np.arange(0.0, args.duration, 1.0/args.imu_hz):
+        msg = Imu()
+        msg.header.stamp = rospy.Time.from_sec(args.start_time + t)
+        msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z = rng.normal(0, 0.1, 3) + [0, 0, 9.8]
+        msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z = rng.normal(0, 0.05, 3)
+        msg.orientation.w = 1.0
+        yield t, "/imu/data", msg
+
+def write_bag(path, args):
+    rng = np.random.default_rng(args.seed)
+    streams = [camera_msgs(rng, args), raw_camera_msgs(rng, args), scan_msgs(rng, args), odom_msgs(rng, args),
+               imu_msgs(rng, args), cmd_vel_msgs(rng, args), pose_msgs(rng, args)]
+    count = 0
+    with rosbag.Bag(path, "w") as bag:
+        for t, topic, msg in heapq.merge(*streams, key=lambda m: m[0]):
+            bag.write(topic, msg, rospy.Time.from_sec(args.start_time + t))
+            count += 1
+    return count
+
+def add_arguments(parser):
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--camera-hz', type=float, default=30)
+    parser.add_argument('--raw-camera-hz', type=float, default=2, help="uncompressed bgr8 frames, 0 for none")
+    parser.add_argument('--beams', type=int, default=720)
+    parser.add_argument('--scan-hz', type=float, default=40)
+    parser.add_argument('--odom-hz', type=float, default=50)
+    parser.add_argument('--imu-hz', type=float, default=200)
+    parser.add_argument('--cmd-vel-hz', type=float, default=20)
+    parser.add_argument('--pose-hz', type=float, default=10)
+    parser.add_argument('--start-time', type=float, default=1600000000.0)
+    parser.add_argument('--seed', type=int, default=0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, default="synthetic.bag")
+    add_arguments(parser)
+    args = parser.parse_args()
+    count = write_bag(args.output, args)
+    print("wrote %d messages to %s" % (count, args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import os
+import time
+import json
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from manifest import Manifest, output_dir_for
+from lease import Lease
+import claim
+
+NUM_TRAJ = 8
+
+
+def fake_convert(bagfile, config, midas_ctx, out_dir=None):
+    # stands in for convert_bagfile: same manifest handling, one small file
+    # per trajectory, and a line in log.txt per conversion that does work
+    manifest = Manifest(out_dir)
+    if manifest.is_complete(bagfile, config):
+        return None
+    resume_from = manifest.resume_from(bagfile, config)
+    os.makedirs(os.path.join(out_dir, "obs"), exist_ok=True)
+    manifest.start(bagfile, config, resume_from)
+    with open(os.path.join(config["output_dir"], "log.txt"), "a") as f:
+        f.write(json.dumps({"bag": os.path.basename(bagfile), "pid": os.getpid(), "resume_from": resume_from}) + "\n")
+    for idx in range(resume_from, NUM_TRAJ):
+        with open(os.path.join(out_dir, "obs", "%d.pt" % idx), "w") as f:
+            f.write(str(idx))
+        manifest.progress(idx + 1)
+        time.sleep(0.01)
+    manifest.complete(NUM_TRAJ * config["traj_steps"], NUM_TRAJ)
+    return NUM_TRAJ * config["traj_steps"], NUM_TRAJ
+
+def run_node(bagfiles, config):
+    claim.convert_bagfile = fake_convert
+    for bagfile in bagfiles:
+        claim.convert_claimed(bagfile, config, None)
+
+def run_nodes(num_nodes, bagfiles, config):
+    ctx = multiprocessing.get_context("spawn")
+    nodes = [ctx.Process(target=run_node, args=(bagfiles, config)) for _ in range(num_nodes)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+        assert node.exitcode == 0
+
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        bag_dir = os.path.join(self.tmp, "bags")
+        os.makedirs(bag_dir)
+        self.bagfiles = []
+        for n in range(6):
+            bagfile = os.path.join(bag_dir, "bag%d.bag" % n)
+            with open(bagfile, "wb") as f:
+                f.write(os.urandom(1024))
+            self.bagfiles.append(bagfile)
+        self.config = {"output_dir": os.path.join(self.tmp, "out"), "traj_steps": 10,
+                       "claim_leases": True, "lease_ttl": 60}
+        os.makedirs(self.config["output_dir"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def log(self):
+        with open(os.path.join(self.config["output_dir"], "log.txt"), "r") as f:
+            return [json.loads(line) for line in f]
+
+    def check_published(self, bagfile):
+        out_dir = output_dir_for(self.config, bagfile)
+        self.assertTrue(Manifest(out_dir).is_complete(bagfile, self.config))
+        self.assertEqual(sorted(os.listdir(os.path.join(out_dir, "obs"))), sorted("%d.pt" % i for i in range(NUM_TRAJ)))
+
+    def test_each_bag_converted_once(self):
+        run_nodes(4, self.bagfiles, self.config)
+        converted = [entry["bag"] for entry in self.log()]
+        self.assertEqual(sorted(converted), sorted(os.path.basename(bagfile) for bagfile in self.bagfiles))
+        for bagfile in self.bagfiles:
+            self.check_published(bagfile)
+        left = os.listdir(self.config["output_dir"]) + os.listdir(claim.lease_dir_for(self.config))
+        self.assertEqual([name for name in left if ".partial." in name or name.endswith(".lease")], [])
+
+    def test_stale_lease_taken_over_and_resumed(self):
+        # a node that crashed after writing 3 trajectories of the first bag
+        bagfile = self.bagfiles[0]
+        out_dir = output_dir_for(self.config, bagfile)
+        partial = out_dir + ".partial.crashed-1"
+        os.makedirs(os.path.join(partial, "obs"))
+        manifest = Manifest(partial)
+        manifest.start(bagfile, self.config)
+        for idx in range(3):
+            with open(os.path.join(partial, "obs", "%d.pt" % idx), "w") as f:
+                f.write(str(idx))
+        manifest.progress(3)
+        lease = Lease(claim.lease_dir_for(self.config), os.path.basename(out_dir), self.config["lease_ttl"])
+        lease.owner = "crashed-1"
+        self.assertTrue(lease.acquire())
+        stale = time.time() - 2 * self.config["lease_ttl"]
+        os.utime(lease.path, (stale, stale))
+
+        run_nodes(3, [bagfile], self.config)
+        self.assertEqual([(entry["bag"], entry["resume_from"]) for entry in self.log()], [("bag0.bag", 3)])
+        self.check_published(bagfile)
+        self.assertFalse(os.path.exists(partial))
+        self.assertFalse(os.path.exists(lease.path))
+
+    def test_live_lease_is_not_taken_over(self):
+        bagfile = self.bagfiles[0]
+        out_dir = output_dir_for(self.config, bagfile)
+        lease = Lease(claim.lease_dir_for(self.config), os.path.basename(out_dir), self.config["lease_ttl"])
+        lease.owner = "running-1"
+        self.assertTrue(lease.acquire())
+        run_nodes(2, [bagfile], self.config)
+        self.assertFalse(os.path.exists(os.path.join(self.config["output_dir"], "log.txt")))
+        self.assertFalse(os.path.exists(out_dir))
+        self.assertTrue(lease.owned())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import unittest
+
+import numpy as np
+
+from utils import convert_Twist, integrate_unicycle
+from rosbag2dataset import convert_topics
+
+HZ = 10
+
+
+class FakeHandler:
+    def get_topic_type(self, topic):
+        return "geometry_msgs/Twist"
+
+
+def twist_config(twist_dt):
+    return {"hz": HZ, "dataset": ["acs", "pos"], "action_noise": 0.0, "lower_bound": [-2.0, -2.0], "upper_bound": [2.0, 2.0],
+            "twist_dt": twist_dt}
+
+
+class TwistStampsTest(unittest.TestCase):
+    def test_slow_cmd_vel_moves_every_tick(self):
+        # cmd_vel at 2 Hz, ticks at 10 Hz: the selected commands repeat, the
+        # pose must still advance by v/hz per tick
+        times = np.arange(0.0, 1.5, 0.5)
+        values = np.tile([[1.0, 0.0]], (len(times), 1))
+        grid = np.arange(0.0, 1.0, 1.0/HZ)
+        view = np.searchsorted(times, grid, side="right") - 1
+        dataset = convert_topics(FakeHandler(), {"cmd_vel": values[view]}, twist_config("stamps"), None, {},
+                                 {"cmd_vel": (times, values)}, grid)
+        np.testing.assert_allclose(dataset["pos"][:, 0], np.arange(1, 11) / HZ)
+        np.testing.assert_allclose(dataset["pos"][:, 1:], 0.0, atol=1e-12)
+
+    def test_command_change_inside_a_tick(self):
+        times = np.array([0.0, 0.25])
+        values = np.array([[1.0, 0.0], [2.0, 0.0]])
+        grid = np.arange(0.0, 0.5, 1.0/HZ)
+        _, pos = convert_Twist(values[[0, 0, 1, 1, 1]], 0.0, [-3.0, -3.0], [3.0, 3.0], hz=HZ, use_pose=True,
+                               stream=(times, values, grid))
+        np.testing.assert_allclose(pos[:, 0], [0.1, 0.2, 0.35, 0.55, 0.75])
+
+    def test_commands_at_tick_rate_match_fixed_step(self):
+        rng = np.random.default_rng(0)
+        values = np.column_stack([rng.uniform(0.0, 1.0, 50), rng.uniform(-1.0, 1.0, 50)])
+        grid = np.arange(50) / HZ
+        _, pos = convert_Twist(values, 0.0, [-2.0, -2.0], [2.0, 2.0], hz=HZ, use_pose=True,
+                               stream=(grid, values, grid))
+        np.testing.assert_allclose(pos, integrate_unicycle(values, 1.0/HZ), atol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
-import torch
-import cv2
 from tqdm import tqdm
-from geometry_msgs.msg import Vector3
-import tf
-from cv_bridge import CvBridge, CvBridgeError
-import matplotlib.pyplot as plt
+
+from profiler import profiler, profiled
+
+# torch, cv2, tf and cv_bridge are imported inside the converters that need
+# them so that importing utils stays cheap for jobs that use none of them
 
 def normalize_depth(depth, bits):
     depth_min = depth.min()
@@ -20,132 +22,373 @@ def normalize_depth(depth, bits):
     elif bits == 2:
         return out.astype("uint16")
 
-def convert_Image(data, height=None, width=None):
-    obs = []
-    bridge = CvBridge()
-    for msg in tqdm(data):
+# encoding -> (channels, name of the cv2 conversion to bgr8)
+IMAGE_ENCODINGS = {
+    "bgr8": (3, None),
+    "rgb8": (3, "COLOR_RGB2BGR"),
+    "bgra8": (4, "COLOR_BGRA2BGR"),
+    "rgba8": (4, "COLOR_RGBA2BGR"),
+    "mono8": (1, "COLOR_GRAY2BGR"),
+}
+
+_bridge = None
+_executors = {}
+
+def get_executor(num_workers, backend="thread"):
+    # pools are kept for the whole run so repeated calls do not respawn workers
+    key = (num_workers, backend)
+    if key not in _executors:
+        if backend == "process":
+            _executors[key] = ProcessPoolExecutor(num_workers)
+        else:
+            _executors[key] = ThreadPoolExecutor(num_workers)
+    return _executors[key]
+
+def map_frames(func, data, num_workers=1, backend="thread"):
+    # ordered map over frames; cv2 releases the GIL so threads scale
+    if num_workers is None or num_workers <= 1:
+        return [func(msg) for msg in tqdm(data)]
+    executor = get_executor(num_workers, backend)
+    return list(tqdm(executor.map(func, data, chunksize=16 if backend == "process" else 1), total=len(data)))
+
+# scale -> cv2 flag that makes libjpeg decode at 1/scale of the resolution
+REDUCED_DECODE = {
+    8: "IMREAD_REDUCED_COLOR_8",
+    4: "IMREAD_REDUCED_COLOR_4",
+    2: "IMREAD_REDUCED_COLOR_2",
+}
+
+def jpeg_size(data):
+    # (height, width) from the SOF header of a JPEG, None for anything else
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i+1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i+5] << 8) | data[i+6], (data[i+7] << 8) | data[i+8]
+        i += 2 + ((data[i+2] << 8) | data[i+3])
+    return None
+
+def center_crop(h, w):
+    # columns of the crop: full height, horizontally centred
+    x0 = int((w-h)*0.5)
+    return x0, w-x0
+
+def reduced_scale(h, w, height, width):
+    # largest libjpeg scale that still leaves at least height x width pixels
+    # inside the crop, so the final resize only ever shrinks
+    if height is None or width is None or w < h:
+        return 1
+    x0, x1 = center_crop(h, w)
+    for scale in sorted(REDUCED_DECODE.keys(), reverse=True):
+        if (x1-x0) // scale >= width and h // scale >= height:
+            return scale
+    return 1
+
+def crop_and_resize(img, height=None, width=None, out=None, scale=1, size=None):
+    # img may be decoded at 1/scale of a size=(h, w) source; the crop is the
+    # one of the full-resolution image either way and the resized frame is
+    # written into out when given
+    import cv2
+    if height is None or width is None:
+        return img
+    if scale == 1:
+        h,w,c = img.shape
+        img = img[0:h, int((w-h)*0.5):w-int((w-h)*0.5), :]
+        return cv2.resize(img, (width, height), dst=out)
+    # crop and resize as one affine map from output pixel centres to the
+    # reduced image, where pixel j covers source pixels [j*scale, (j+1)*scale)
+    h, w = size
+    x0, x1 = center_crop(h, w)
+    sx = (x1-x0) / width
+    sy = h / height
+    offset = (scale-1) * 0.5
+    M = np.array([[sx/scale, 0, (x0 + 0.5*sx - 0.5 - offset)/scale],
+                  [0, sy/scale, (0.5*sy - 0.5 - offset)/scale]])
+    return cv2.warpAffine(img, M, (width, height), dst=out,
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+
+def decode_Image(msg, height=None, width=None, out=None):
+    import cv2
+    global _bridge
+    if msg.encoding in IMAGE_ENCODINGS:
+        channels, code = IMAGE_ENCODINGS[msg.encoding]
+        img = np.frombuffer(msg.data, np.uint8).reshape(msg.height, msg.step)
+        img = img[:, :msg.width*channels].reshape(msg.height, msg.width, channels)
+        if code is not None:
+            img = cv2.cvtColor(img, getattr(cv2, code))
+    else:
+        from cv_bridge import CvBridge, CvBridgeError
+        if _bridge is None:
+            _bridge = CvBridge()
         try:
-            img = bridge.imgmsg_to_cv2(msg,"bgr8")
+            img = _bridge.imgmsg_to_cv2(msg,"bgr8")
         except CvBridgeError as e:
             print(e)
-        if height is not None and width is not None:
-            h,w,c = img.shape
-            img = img[0:h, int((w-h)*0.5):w-int((w-h)*0.5), :]
-            img = cv2.resize(img, (height, width))
-        obs.append(img)
-    return obs
-
-def convert_CompressedImage(data, height=None, width=None):
-    obs = []
-    for msg in tqdm(data):
-        img = cv2.imdecode(np.fromstring(msg.data, np.uint8), cv2.IMREAD_COLOR)
-        if height is not None and width is not None:
-            h,w,c = img.shape
-            img = img[0:h, int((w-h)*0.5):w-int((w-h)*0.5), :]
-            img = cv2.resize(img, (height, width))
-        obs.append(img)
-    return obs
-
-def convert_CompressedImage_depth(obs, midas, device, transform, height=None, width=None):
-    convert_obsds = []
-    for i in obs:
-        i = transform(i).to(device)
-        convert_obsd = midas(i)
-        convert_obsd = torch.nn.functional.interpolate(
-            convert_obsd.unsqueeze(1),
-            size=(height,width),
-            mode="bicubic",
-            align_corners=False,
-        ).squeeze()
-        convert_obsd_cpu = convert_obsd.to('cpu').detach().numpy().copy()
-        convert_obsd_cpu = normalize_depth(convert_obsd_cpu, 1)
-        convert_obsds.append(convert_obsd_cpu/255)
-        del i
-        del convert_obsd
-
-    return convert_obsds
-
-def convert_obsd2point(obsd):
-    h, w = obsd.shape
-    obsd = obsd[:int(h/2), :]
-    obsd_point = np.amax(obsd, axis=0)
-    obsd_point_var = np.var(obsd_point)
-    if obsd_point_var < 0.1:
-        obsd_point = np.amin(obsd, axis=0)
-    print(obsd_point)
-    return obsd_point
-
-def convert_CompressedImage_depth2point(obs, midas, device, transform, height=None, width=None):
-    obsds = convert_CompressedImage_depth(obs, midas, device, transform, height, width)
-    obsd_points = []
-    for obsd in obsds:
-        obsd_points.append(convert_obsd2point(obsd))
-    return obsd_points
+            raise
+    return crop_and_resize(img, height, width, out)
 
+def decode_CompressedImage(msg, height=None, width=None, out=None, reduced=True):
+    import cv2
+    data = np.frombuffer(msg.data, np.uint8)
+    scale = 1
+    size = jpeg_size(msg.data) if reduced and height is not None and width is not None else None
+    if size is not None:
+        scale = reduced_scale(size[0], size[1], height, width)
+    if scale == 1:
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    else:
+        img = cv2.imdecode(data, getattr(cv2, REDUCED_DECODE[scale]))
+    return crop_and_resize(img, height, width, out, scale, size)
 
-def convert_Odometry(data, action_noise, lower_bound, upper_bound):
-    acs = []
-    pos = []
+def decode_frames(decode, data, height=None, width=None, num_workers=1, backend="thread", out=None):
+    # with a target size every frame is decoded straight into its slot of one
+    # preallocated (N, height, width, 3) buffer, which may also be passed in
+    # as a strided view of a larger one; process workers cannot write into
+    # it, so their frames are copied in
+    if height is None or width is None:
+        return map_frames(decode, data, num_workers, backend)
+    if out is None:
+        out = np.empty((len(data), height, width, 3), dtype=np.uint8)
+    if backend == "process" and num_workers is not None and num_workers > 1:
+        for i, img in enumerate(map_frames(decode, data, num_workers, backend)):
+            out[i] = img
+    else:
+        map_frames(lambda i: decode(data[i], out=out[i]), range(len(data)), num_workers, backend)
+    return out
+
+@profiled("convert_Image")
+def convert_Image(data, height=None, width=None, num_workers=1, backend="thread", out=None):
+    return decode_frames(partial(decode_Image, height=height, width=width), data, height, width, num_workers, backend, out)
+
+@profiled("convert_CompressedImage")
+def convert_CompressedImage(data, height=None, width=None, num_workers=1, backend="thread", reduced=True, out=None):
+    return decode_frames(partial(decode_CompressedImage, height=height, width=width, reduced=reduced), data, height, width, num_workers, backend, out)
+
+def normalize_depths(depths):
+    # normalize_depth(depth, 1) for an (N, H, W) float tensor in one pass on
+    # the tensor's device, so only uint8 depths are copied to the host
+    import torch
+    flat = depths.reshape(len(depths), -1)
+    depth_min = flat.amin(dim=1).view(-1, 1, 1)
+    depth_max = flat.amax(dim=1).view(-1, 1, 1)
+    out = 255 * (depths - depth_min) / (depth_max - depth_min)
+    out = torch.where(depth_max - depth_min > np.finfo("float").eps, out, torch.zeros_like(out))
+    return out.to(torch.uint8)
+
+@profiled("midas_inference")
+def predict_depth(obs, midas, device, transform, height=None, width=None, batch_size=1):
+    # (N, height, width) uint8 depths, normalized per frame
+    import torch
+    depths = np.empty((len(obs), height, width), dtype=np.uint8)
+    with torch.inference_mode():
+        for i in range(0, len(obs), batch_size):
+            batch = torch.cat([transform(img) for img in obs[i:i+batch_size]]).to(device)
+            convert_obsd = midas(batch)
+            convert_obsd = torch.nn.functional.interpolate(
+                convert_obsd.unsqueeze(1),
+                size=(height,width),
+                mode="bicubic",
+                align_corners=False,
+            ).squeeze(1)
+            # one device-to-host copy per batch
+            depths[i:i+len(batch)] = normalize_depths(convert_obsd).to('cpu').numpy()
+            del batch
+            del convert_obsd
+    return depths
+
+def predict_depth_cached(obs, midas, device, transform, height=None, width=None, batch_size=1, cache=None, keys=None):
+    if cache is None:
+        return predict_depth(obs, midas, device, transform, height, width, batch_size)
+    depths = np.empty((len(obs), height, width), dtype=np.uint8)
+    missing = []
+    with profiler.stage("depth_cache_get", items=len(keys)):
+        for i, key in enumerate(keys):
+            depth = cache.get(key)
+            if depth is None:
+                missing.append(i)
+            else:
+                depths[i] = depth
+    # hit and miss counts go into profile.json, which is kept per bag and
+    # aggregated over scheduler and segment workers
+    profiler.add("depth_cache_hit", items=len(keys) - len(missing))
+    profiler.add("depth_cache_miss", items=len(missing))
+    predicted = predict_depth([obs[i] for i in missing], midas, device, transform, height, width, batch_size)
+    with profiler.stage("depth_cache_put", items=len(missing)):
+        for i, depth in zip(missing, predicted):
+            cache.put(keys[i], depth)
+            depths[i] = depth
+    return depths
+
+@profiled("depth_to_points")
+def depth_to_points(depths):
+    # (N, H, W) uint8 depths -> (N, W) float32 point scan in [0, 1]: the
+    # column max of the upper half of each frame, or the column min for
+    # frames where the max hardly varies along the row
+    h = depths.shape[1]
+    upper = depths[:, :int(h/2), :]
+    points = upper.max(axis=1) / 255
+    lowest = upper.min(axis=1) / 255
+    use_min = points.var(axis=1) < 0.1
+    return np.where(use_min[:, None], lowest, points).astype(np.float32)
+
+@profiled("convert_CompressedImage_depth")
+def convert_CompressedImage_depth(obs, midas, device, transform, height=None, width=None, batch_size=1, cache=None, keys=None):
+    depths = predict_depth_cached(obs, midas, device, transform, height, width, batch_size, cache, keys)
+    return depths / np.float32(255)
+
+@profiled("convert_CompressedImage_depth2point")
+def convert_CompressedImage_depth2point(obs, midas, device, transform, height=None, width=None, batch_size=1, cache=None, keys=None):
+    depths = predict_depth_cached(obs, midas, device, transform, height, width, batch_size, cache, keys)
+    return depth_to_points(depths)
+
+
+class ColumnBuffer:
+    # rows pushed one message at a time into a preallocated array that doubles
+    # when full, so numeric topics are stored without keeping the messages
+    def __init__(self, row, width=None, dtype=np.float64, finalize=None, capacity=1024):
+        self.row = row
+        self.width = width
+        self.dtype = dtype
+        self.finalize = finalize
+        self.capacity = capacity
+        self.buffer = None
+        self.size = 0
+
+    def push(self, msg):
+        values = self.row(msg)
+        if self.buffer is None:
+            if self.width is None:
+                self.width = len(values)
+            self.buffer = np.empty((self.capacity, self.width), dtype=self.dtype)
+        if self.size == len(self.buffer):
+            self.buffer = np.concatenate([self.buffer, np.empty_like(self.buffer)])
+        self.buffer[self.size] = values
+        self.size += 1
+
+    def array(self):
+        if self.buffer is None:
+            columns = np.empty((0, self.width or 0), dtype=self.dtype)
+        else:
+            columns = self.buffer[:self.size]
+        if self.finalize is not None:
+            columns = self.finalize(columns)
+        return columns
+
+def odometry_row(msg):
+    pose = msg.pose.pose
+    return (msg.twist.twist.linear.x, msg.twist.twist.angular.z,
+            pose.position.x, pose.position.y,
+            pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w)
+
+def twist_row(msg):
+    return (msg.linear.x, msg.angular.z)
+
+def laserscan_row(msg):
+    return msg.ranges
+
+def imu_row(msg):
+    return (msg.linear_acceleration.x,
+            msg.linear_acceleration.y,
+            msg.linear_acceleration.z,
+            msg.angular_velocity.x,
+            msg.angular_velocity.y,
+            msg.angular_velocity.z)
+
+def pose_row(msg):
+    pose = msg.pose.pose
+    return (pose.position.x, pose.position.y,
+            pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w)
+
+def quaternion_columns(columns):
+    # replaces the trailing x, y, z, w columns by yaw
+    return np.column_stack([columns[:, :-4], quaternion_to_yaw(columns[:, -4:])])
+
+# topic type -> (row, width, dtype, finalize); finalized columns are
+#   Odometry: vx, wz, x, y, yaw    Twist: vx, wz    LaserScan: ranges
+#   Imu: ax, ay, az, wx, wy, wz    PoseWithCovarianceStamped: x, y, yaw
+COLUMN_EXTRACTORS = {
+    "nav_msgs/Odometry": (odometry_row, 8, np.float64, quaternion_columns),
+    "geometry_msgs/Twist": (twist_row, 2, np.float64, None),
+    "sensor_msgs/LaserScan": (laserscan_row, None, np.float32, None),
+    "sensor_msgs/Imu": (imu_row, 6, np.float64, None),
+    "geometry_msgs/PoseWithCovarianceStamped": (pose_row, 6, np.float64, quaternion_columns),
+}
+
+# angle columns of the finalized arrays, for resampler.interpolate
+ANGLE_COLUMNS = {
+    "nav_msgs/Odometry": (4,),
+    "geometry_msgs/PoseWithCovarianceStamped": (2,),
+}
+
+def make_column_buffer(topic_type):
+    row, width, dtype, finalize = COLUMN_EXTRACTORS[topic_type]
+    return ColumnBuffer(row, width, dtype, finalize)
+
+def extract_columns(data, topic_type):
+    # data is either a list of messages or already extracted columns
+    if isinstance(data, np.ndarray):
+        return data
+    columns = make_column_buffer(topic_type)
     for msg in tqdm(data):
-        # action
-        vel = np.array([msg.twist.twist.linear.x, msg.twist.twist.angular.z])
-        vel = add_random_noise(vel, action_noise, lower_bound, upper_bound)
-        acs.append(vel)
-        # pose
-        pose = get_pose_from_msg(msg)
-        pos.append(pose)
+        columns.push(msg)
+    return columns.array()
+
+@profiled("convert_Odometry")
+def convert_Odometry(data, action_noise, lower_bound, upper_bound):
+    columns = extract_columns(data, "nav_msgs/Odometry")
+    # action
+    acs = add_random_noise(columns[:, 0:2].copy(), action_noise, lower_bound, upper_bound)
+    # pose
+    pos = columns[:, 2:5].copy()
     return acs, pos
 
-def convert_Twist(data, action_noise, lower_bound, upper_bound, hz=None, use_pose=False):
-    acs = []
-    if use_pose:
-        pos = []
-        pre_pose = [0.0, 0.0, 0.0]
-    for msg in tqdm(data):
-        # action
-        vel = np.array([msg.linear.x, msg.angular.z])
-        if not lower_bound[0] < vel[0] <upper_bound[0]:
-            vel[0] = 0.0
-        if not lower_bound[1] < vel[1] <upper_bound[1]:
-            vel[1] = 0.0
-        # pose
-        if use_pose:
-            pose = state_transition(pre_pose, vel, hz)
-            pos.append(pose)
-            pre_pose = pose
-        vel = add_random_noise(vel, action_noise, lower_bound, upper_bound)
-        acs.append(vel)
+@profiled("convert_Twist")
+def convert_Twist(data, action_noise, lower_bound, upper_bound, hz=None, use_pose=False, init_pose=None, stream=None):
+    vel = extract_columns(data, "geometry_msgs/Twist").copy()
+    # action
+    lower_bound = np.asarray(lower_bound)
+    upper_bound = np.asarray(upper_bound)
+    vel[~((lower_bound < vel) & (vel < upper_bound))] = 0.0
+    # pose
+    if use_pose and stream is not None:
+        # stream is (times, data) of every message plus the tick grid
+        times, raw, grid = stream
+        raw = extract_columns(raw, "geometry_msgs/Twist").copy()
+        raw[~((lower_bound < raw) & (raw < upper_bound))] = 0.0
+        pos = integrate_unicycle_at(times, raw, grid[0], grid + 1.0 / hz, init_pose)
+    elif use_pose:
+        pos = integrate_unicycle(vel, 1.0 / hz, init_pose)
+    acs = add_random_noise(vel, action_noise, lower_bound, upper_bound)
     if use_pose:
         return acs, pos
     else:
         return acs
 
+@profiled("convert_LaserScan")
 def convert_LaserScan(data):
-    lidar = []
-    for msg in tqdm(data):
-        lidar.append(np.array(msg.ranges))
+    lidar = extract_columns(data, "sensor_msgs/LaserScan")
     return lidar
 
+@profiled("convert_Imu")
 def convert_Imu(data):
-    imu = []
-    for msg in tqdm(data):
-        # imu
-        imu_data = np.array([
-            msg.linear_acceleration.x,
-            msg.linear_acceleration.y,
-            msg.linear_acceleration.z,
-            msg.angular_velocity.x,
-            msg.angular_velocity.y,
-            msg.angular_velocity.z])
-        imu.append(imu_data)
+    # imu
+    imu = extract_columns(data, "sensor_msgs/Imu")
     return imu
 
+@profiled("convert_PoseWithCovarianceStamped")
 def convert_PoseWithCovarianceStamped(data):
-    global_pos = []
-    for msg in tqdm(data):
-        # global pose
-        pose = get_pose_from_msg(msg)
-        global_pos.append(pose)
+    # global pose
+    global_pos = extract_columns(data, "geometry_msgs/PoseWithCovarianceStamped")
     return global_pos
 
 def transform_pose(pose, base_pose):
@@ -157,7 +400,49 @@ def transform_pose(pose, base_pose):
                            np.arctan2(np.sin(yaw), np.cos(yaw))])
     return trans_pose
 
+def transform_poses(poses, base_poses):
+    # array version of transform_pose, (...,3) arrays broadcast against each other
+    poses = np.asarray(poses, dtype=np.float64)
+    base_poses = np.asarray(base_poses, dtype=np.float64)
+    x = poses[..., 0] - base_poses[..., 0]
+    y = poses[..., 1] - base_poses[..., 1]
+    yaw = poses[..., 2] - base_poses[..., 2]
+    cos = np.cos(base_poses[..., 2])
+    sin = np.sin(base_poses[..., 2])
+    return np.stack([ x*cos + y*sin,
+                     -x*sin + y*cos,
+                     np.arctan2(np.sin(yaw), np.cos(yaw))], axis=-1)
+
+def relative_trajectories(poses, num_traj, traj_steps):
+    # (num_traj, traj_steps, 3), every trajectory relative to its first pose
+    poses = np.asarray(poses, dtype=np.float64)[:num_traj*traj_steps].reshape(num_traj, traj_steps, 3)
+    return transform_poses(poses, poses[:, :1])
+
+def goal_trajectories(poses, num_traj, traj_steps, goal_steps):
+    # (num_traj, traj_steps+goal_steps, 3), the last pose of every window
+    # seen from each pose of that window
+    poses = np.asarray(poses, dtype=np.float64)
+    idx = np.arange(num_traj)[:, None]*traj_steps + np.arange(traj_steps+goal_steps)
+    windows = poses[idx]
+    return transform_poses(windows[:, -1:], windows)
+
+def quaternion_to_yaw(quaternions):
+    # yaw of tf.transformations.euler_from_quaternion (sxyz) for (...,4) x,y,z,w
+    # arrays; quaternions are not assumed to be normalized, as in tf
+    q = np.asarray(quaternions, dtype=np.float64)
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    n = x*x + y*y + z*z + w*w
+    eps = np.finfo(float).eps * 4.0
+    safe_n = np.where(n < eps, 1.0, n)
+    m00 = 1.0 - 2.0*(y*y + z*z)/safe_n
+    m10 = 2.0*(x*y + w*z)/safe_n
+    cy = np.sqrt(m00*m00 + m10*m10)
+    yaw = np.arctan2(m10, m00)
+    return np.where((n < eps) | (cy <= eps), 0.0, yaw)
+
 def quaternion_to_euler(quaternion):
+    import tf
+    from geometry_msgs.msg import Vector3
     e = tf.transformations.euler_from_quaternion((quaternion.x, quaternion.y, quaternion.z, quaternion.w))
     return Vector3(x=e[0], y=e[1], z=e[2])
 
@@ -173,6 +458,43 @@ def add_random_noise(action, std, lb, ub):
     action += np.random.randn(*action.shape) * std
     return action.clip(lb, ub)
 
+def integrate_unicycle(actions, dt, init_pose=None):
+    # vectorized state_transition over a whole sequence: poses[k] is the pose
+    # after applying actions[k] for dt (a scalar or one value per action)
+    actions = np.asarray(actions, dtype=np.float64).reshape(-1, 2)
+    dt = np.broadcast_to(np.asarray(dt, dtype=np.float64), (len(actions),))
+    if init_pose is None:
+        init_pose = [0.0, 0.0, 0.0]
+    v = actions[:, 0]
+    w = actions[:, 1]
+    # heading before each step; sin/cos are periodic, so normalizing only at the
+    # end gives the same values as normalizing after every step
+    theta = init_pose[2] + np.concatenate([[0.0], np.cumsum(w*dt)])
+    pre_theta = theta[:-1]
+    straight = np.abs(w) < 1e-10
+    safe_w = np.where(straight, 1.0, w)
+    dx = np.where(straight, v*np.cos(pre_theta)*dt,
+                  v/safe_w*(np.sin(pre_theta+w*dt)-np.sin(pre_theta)))
+    dy = np.where(straight, v*np.sin(pre_theta)*dt,
+                  v/safe_w*(-np.cos(pre_theta+w*dt)+np.cos(pre_theta)))
+    poses = np.empty((len(actions), 3), dtype=np.float64)
+    poses[:, 0] = np.cumsum(np.concatenate([[init_pose[0]], dx]))[1:]
+    poses[:, 1] = np.cumsum(np.concatenate([[init_pose[1]], dy]))[1:]
+    poses[:, 2] = angle_normalize(theta[1:])
+    return poses
+
+def integrate_unicycle_at(times, actions, start, ends, init_pose=None):
+    # poses at the sorted times ends, integrating from start with every
+    # action applied from its stamp until the next one (the first action also
+    # covers anything before its stamp)
+    times = np.asarray(times, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    inner = times[(times > start) & (times < ends[-1])]
+    edges = np.unique(np.concatenate([[start], inner, ends]))
+    active = np.clip(np.searchsorted(times, edges[:-1], side="right") - 1, 0, None)
+    poses = integrate_unicycle(np.asarray(actions)[active], np.diff(edges), init_pose)
+    return poses[np.searchsorted(edges, ends) - 1]
+
 def state_transition(pose, action, hz):
     pre_theta = pose[2]
     DT = 1.0 / hz
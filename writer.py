@@ -0,0 +1,239 @@
+import os
+import glob
+import json
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from profiler import profiler
+
+
+class PtWriter:
+    # default layout: out_dir/<data_name>/<n>.pt, one torch.save per field
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def write(self, file_count, data_name, data):
+        import torch
+        path = os.path.join(self.out_dir, data_name, "%d.pt" % (file_count))
+        if data.untyped_storage().nbytes() > data.element_size() * data.nelement():
+            # torch.save writes the whole storage behind a view, not just the slice
+            data = data.clone()
+        with profiler.stage("write", items=1) as record:
+            with open(path, "wb") as f:
+                torch.save(data, f)
+                record["bytes_written"] = f.tell()
+
+    def close(self):
+        pass
+
+
+class ShardWriter:
+    # out_dir/<data_name>/shard_<k>.bin holds raw little-endian trajectories
+    # back to back; out_dir/<data_name>/index.json maps trajectory number to
+    # (shard, byte offset, shape) so readers can np.memmap them without copies
+    def __init__(self, out_dir, shard_bytes=1 << 30):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.fields = {}
+
+    def write(self, file_count, data_name, data):
+        array = np.ascontiguousarray(data.numpy())
+        if data_name not in self.fields:
+            self.fields[data_name] = {"dtype": array.dtype.str, "shard": -1, "file": None, "offset": 0, "trajectories": {}}
+        field = self.fields[data_name]
+        with profiler.stage("write", items=1) as record:
+            if field["file"] is None or (field["offset"] > 0 and field["offset"] + array.nbytes > self.shard_bytes):
+                self.next_shard(data_name)
+            field["file"].write(array.tobytes())
+            record["bytes_written"] = array.nbytes
+        field["trajectories"][file_count] = [self.shard_name(field["shard"]), field["offset"], list(array.shape)]
+        field["offset"] += array.nbytes
+
+    def shard_name(self, shard):
+        return "shard_%05d.bin" % (shard)
+
+    def next_shard(self, data_name):
+        field = self.fields[data_name]
+        if field["file"] is not None:
+            field["file"].close()
+        field["shard"] += 1
+        field["offset"] = 0
+        field["file"] = open(os.path.join(self.out_dir, data_name, self.shard_name(field["shard"])), "wb")
+
+    def close(self):
+        for data_name, field in self.fields.items():
+            if field["file"] is not None:
+                field["file"].close()
+                field["file"] = None
+            index = {
+                "dtype": field["dtype"],
+                "trajectories": {str(n): entry for n, entry in sorted(field["trajectories"].items())},
+            }
+            path = os.path.join(self.out_dir, data_name, "index.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump(index, f)
+            os.replace(path + ".tmp", path)
+
+
+class JpegWriter:
+    # fields in jpeg_fields are stored as JPEG frames packed back to back in
+    # out_dir/<data_name>/frames_<token>.bin; frames_<token>.npz holds the
+    # byte offset and size of every frame and the first frame, frame count
+    # and shape of every trajectory. every writer instance has its own token,
+    # so segment workers never append to the same file. other fields go to
+    # the wrapped writer
+    def __init__(self, writer, out_dir, fields, quality=95):
+        self.writer = writer
+        self.out_dir = out_dir
+        self.fields = set(fields)
+        self.quality = quality
+        self.token = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.files = {}
+        self.index = {}
+
+    def write(self, file_count, data_name, data):
+        if data_name not in self.fields:
+            return self.writer.write(file_count, data_name, data)
+        import cv2
+        frames = data.numpy()
+        shape = frames.shape
+        if frames.dtype != np.uint8:
+            frames = np.clip(np.rint(frames), 0, 255).astype(np.uint8)
+        # (H, W, C) is a single frame such as goal_obs, (N, H, W, C) a trajectory
+        frames = frames.reshape((-1,) + shape[-3:])
+        with profiler.stage("jpeg_encode", items=len(frames)):
+            encoded = [cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1] for frame in frames]
+        with self.lock:
+            with profiler.stage("write", items=1) as record:
+                if data_name not in self.files:
+                    self.files[data_name] = open(os.path.join(self.out_dir, data_name, "frames_%s.bin" % self.token), "wb")
+                    self.index[data_name] = {"offsets": [], "sizes": [], "trajectories": [], "first": [], "count": [], "shapes": []}
+                f = self.files[data_name]
+                index = self.index[data_name]
+                index["trajectories"].append(file_count)
+                index["first"].append(len(index["offsets"]))
+                index["count"].append(len(encoded))
+                index["shapes"].append(shape)
+                for buf in encoded:
+                    index["offsets"].append(f.tell())
+                    index["sizes"].append(len(buf))
+                    f.write(buf.tobytes())
+                record["bytes_written"] = sum(len(buf) for buf in encoded)
+
+    def close(self):
+        for data_name, f in self.files.items():
+            f.close()
+            index = self.index[data_name]
+            path = os.path.join(self.out_dir, data_name, "frames_%s.npz" % self.token)
+            np.savez(path + ".tmp.npz",
+                     offsets=np.array(index["offsets"], dtype=np.int64), sizes=np.array(index["sizes"], dtype=np.int64),
+                     trajectories=np.array(index["trajectories"], dtype=np.int64), first=np.array(index["first"], dtype=np.int64),
+                     count=np.array(index["count"], dtype=np.int64), shapes=np.array(index["shapes"], dtype=np.int64))
+            os.replace(path + ".tmp.npz", path)
+        self.files = {}
+        self.writer.close()
+
+
+class AsyncWriter:
+    # hands writes to background threads so the conversion loop does not wait
+    # on the filesystem. write() returns a future and blocks while more than
+    # max_pending_bytes of tensors are queued; the first failure makes later
+    # write() calls and close() raise
+    def __init__(self, writer, num_threads=4, max_pending_bytes=512 << 20):
+        self.writer = writer
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.cond = threading.Condition()
+        self.errors = []
+
+    def write(self, file_count, data_name, data):
+        self.check()
+        nbytes = data.element_size() * data.nelement()
+        with profiler.stage("write_wait"):
+            with self.cond:
+                while self.pending_bytes > 0 and self.pending_bytes + nbytes > self.max_pending_bytes:
+                    self.cond.wait()
+                self.pending_bytes += nbytes
+        return self.executor.submit(self.run, file_count, data_name, data, nbytes)
+
+    def run(self, file_count, data_name, data, nbytes):
+        try:
+            self.writer.write(file_count, data_name, data)
+        except Exception:
+            with self.cond:
+                self.errors.append((file_count, data_name, traceback.format_exc()))
+            raise
+        finally:
+            with self.cond:
+                self.pending_bytes -= nbytes
+                self.cond.notify_all()
+
+    def check(self):
+        with self.cond:
+            if len(self.errors) == 0:
+                return
+            file_count, data_name, error = self.errors[0]
+            count = len(self.errors)
+        raise RuntimeError("%d writes failed, first: %s of trajectory %d\n%s" % (count, data_name, file_count, error))
+
+    def close(self):
+        with profiler.stage("write_flush"):
+            self.executor.shutdown(wait=True)
+        self.check()
+        self.writer.close()
+
+
+def make_writer(out_dir, config):
+    if config.get("output_format", "pt") == "shard":
+        writer = ShardWriter(out_dir, int(config.get("shard_mb", 1024) * (1 << 20)))
+        # shards are appended in order, so only one thread may write them
+        num_threads = min(config.get("writer_threads", 4), 1)
+    else:
+        writer = PtWriter(out_dir)
+        num_threads = config.get("writer_threads", 4)
+    if config.get("jpeg_fields"):
+        writer = JpegWriter(writer, out_dir, config["jpeg_fields"], config.get("jpeg_quality", 95))
+    if num_threads <= 0:
+        return writer
+    return AsyncWriter(writer, num_threads, int(config.get("writer_queue_mb", 512) * (1 << 20)))
+
+def load_jpeg_index(field_dir):
+    # {trajectory number: (frames file, byte offsets, sizes, shape)} over
+    # every frames_<token>.npz written by JpegWriter into field_dir
+    trajectories = {}
+    for path in sorted(glob.glob(os.path.join(field_dir, "frames_*.npz"))):
+        with np.load(path) as index:
+            offsets = index["offsets"]
+            sizes = index["sizes"]
+            for file_count, first, count, shape in zip(index["trajectories"], index["first"], index["count"], index["shapes"]):
+                trajectories[int(file_count)] = (path[:-len(".npz")] + ".bin", offsets[first:first+count],
+                                                 sizes[first:first+count], tuple(int(n) for n in shape))
+    return trajectories
+
+def load_shard_index(field_dir):
+    # {trajectory number: (shard file, byte offset, shape)} and the dtype of
+    # a field written by ShardWriter into field_dir
+    with open(os.path.join(field_dir, "index.json"), "r") as f:
+        index = json.load(f)
+    trajectories = {}
+    for file_count, (shard, offset, shape) in index["trajectories"].items():
+        trajectories[int(file_count)] = (os.path.join(field_dir, shard), offset, tuple(shape))
+    return trajectories, np.dtype(index["dtype"])
+
+def shard_view(shard, offset, shape, dtype):
+    # zero-copy view of one trajectory in a memory-mapped shard (np.uint8,
+    # copy-on-write, so torch.from_numpy gets a writable array)
+    count = int(np.prod(shape))
+    return shard[offset:offset + count*dtype.itemsize].view(dtype).reshape(shape)
+
+def load_trajectory(out_dir, data_name, file_count):
+    # zero-copy view of one trajectory written by ShardWriter
+    trajectories, dtype = load_shard_index(os.path.join(out_dir, data_name))
+    path, offset, shape = trajectories[file_count]
+    return shard_view(np.memmap(path, dtype=np.uint8, mode="c"), offset, shape, dtype)